@@ -0,0 +1,550 @@
+"""
+Benchmark of Prometheus Docker Discovery against a simulated Docker daemon
+
+The fake daemon is served from this process over a unix socket, while the service runs in a child process,
+so that its CPU time and peak memory are measured without the daemon.
+
+Example:
+
+    python benchmark.py --containers 10 100 1000 --labels 5 --latency stats=0.01 --engine poll
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http import HTTPStatus
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlparse
+
+API_VERSION = "1.45"
+STREAM_INTERVAL = 1.0
+# endpoints whose latency can be configured, keyed by the names used on the command line
+ENDPOINTS = {
+    "version": re.compile(r"^/version$"),
+    "list": re.compile(r"^/containers/json$"),
+    "inspect": re.compile(r"^/containers/(?P<id>[0-9a-f]{64})/json$"),
+    "stats": re.compile(r"^/containers/(?P<id>[0-9a-f]{64})/stats$"),
+    "df": re.compile(r"^/system/df$"),
+    "events": re.compile(r"^/events$"),
+}
+
+
+class FakeDocker:
+    """
+    In-memory state of the simulated Docker daemon
+    """
+
+    def __init__(self, containers: int, labels: int, latency: dict[str, float]):
+        self.latency = latency
+        self.counts = dict[str, int]()
+        self.connections = 0
+        self._loop = asyncio.new_event_loop()
+        self._stopped = asyncio.Event()
+        self._thread: threading.Thread | None = None
+        self.containers = {
+            container["Id"]: container
+            for container in (
+                self._container(index, labels) for index in range(containers)
+            )
+        }
+
+    @staticmethod
+    def _container(index: int, labels: int) -> dict:
+        container_labels = {
+            "prometheus.job": f"job-{index % 10}",
+            "prometheus.metrics.port": "8080",
+            **{
+                f"prometheus.labels.label{label}": f"value-{index}-{label}"
+                for label in range(labels)
+            },
+            # exercises the escaping of label values
+            "prometheus.labels.description": f'container "{index}"\\\nof the benchmark',
+        }
+
+        return {
+            "Id": f"{index:064x}",
+            "Names": [f"/container-{index}"],
+            "Image": "alpine:latest",
+            "ImageID": "sha256:" + "a" * 64,
+            "Labels": container_labels,
+            "State": "running",
+            "Status": "Up 1 hour",
+            "Ports": [
+                {
+                    "IP": "0.0.0.0",
+                    "PrivatePort": 8080,
+                    "PublicPort": 10000 + index,
+                    "Type": "tcp",
+                }
+            ],
+            "Mounts": [{"Name": f"volume-{index}"}],
+        }
+
+    def start(self, path: str):
+        """
+        Serve the daemon API on the unix socket `path` from a thread of its own
+        """
+
+        started = threading.Event()
+        self._thread = threading.Thread(
+            target=self._loop.run_until_complete,
+            args=(self._serve(path, started),),
+            daemon=True,
+        )
+        self._thread.start()
+        started.wait()
+
+    def stop(self):
+        if self._thread is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+            self._thread.join()
+            self._thread = None
+            self._loop.close()
+
+    async def _serve(self, path: str, started: threading.Event):
+        # a single event loop answers all connections, so that the daemon does not become the bottleneck
+        # of the threads contending for the GIL when the service opens hundreds of connections
+        connections = set[asyncio.Task]()
+
+        async def connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            connections.add(task := asyncio.current_task())
+            self.connections += 1
+            try:
+                await self._connection(reader, writer)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                connections.discard(task)
+
+        server = await asyncio.start_unix_server(connect, path, backlog=1024)
+        started.set()
+        await self._stopped.wait()
+        server.close()
+
+        for task in connections:
+            task.cancel()
+
+        await asyncio.gather(*connections, return_exceptions=True)
+
+    async def _connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        try:
+            while request_line := await reader.readline():
+                # requests of the Docker API clients have no body, so the headers are skipped
+                while await reader.readline() not in (b"\r\n", b""):
+                    pass
+
+                _, target, _ = request_line.decode().split(" ", 2)
+
+                if not await self._request(writer, target):
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _request(self, writer: asyncio.StreamWriter, target: str) -> bool:
+        """
+        Answer a single request, return whether the connection can be reused
+        """
+
+        url = urlparse(target)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        query = parse_qs(url.query)
+
+        for endpoint, pattern in ENDPOINTS.items():
+            if match := pattern.match(path):
+                break
+        else:
+            await self._send(writer, 404, {"message": "page not found"})
+            return True
+
+        self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+        if delay := self.latency.get(endpoint):
+            await asyncio.sleep(delay)
+
+        stream = query.get("stream", ["true"])[0].lower() not in ("0", "false")
+        one_shot = query.get("one-shot", ["false"])[0].lower() in ("1", "true")
+
+        if endpoint in ("inspect", "stats") and match["id"] not in self.containers:
+            await self._send(writer, 404, {"message": "No such container"})
+        elif endpoint == "version":
+            await self._send(
+                writer, 200, {"ApiVersion": API_VERSION, "Version": "26.0.0"}
+            )
+        elif endpoint == "list":
+            filters = json.loads(query.get("filters", ["{}"])[0])
+            await self._send(writer, 200, self.list(filters))
+        elif endpoint == "inspect":
+            await self._send(writer, 200, self.inspect(self.containers[match["id"]]))
+        elif endpoint == "df":
+            await self._send(writer, 200, self.df())
+        elif endpoint == "stats" and not stream:
+            await self._send(writer, 200, self.stats(time.time(), one_shot))
+        else:
+            # streaming stats and events are kept open until the daemon is stopped
+            await self._stream(writer, endpoint == "stats")
+            return False
+
+        return True
+
+    async def _send(self, writer: asyncio.StreamWriter, status: int, body: Any):
+        content = json.dumps(body).encode()
+        writer.write(
+            b"HTTP/1.1 %d %s\r\n" % (status, HTTPStatus(status).phrase.encode())
+            + b"Content-Type: application/json\r\n"
+            + b"Content-Length: %d\r\n\r\n" % len(content)
+            + content
+        )
+        await writer.drain()
+
+    async def _stream(self, writer: asyncio.StreamWriter, stats: bool):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Transfer-Encoding: chunked\r\n\r\n"
+        )
+
+        while True:
+            if stats:
+                chunk = json.dumps(self.stats(time.time(), False)).encode() + b"\n"
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+
+            await writer.drain()
+            await asyncio.sleep(STREAM_INTERVAL)
+
+    def list(self, filters: dict) -> list[dict]:
+        return [
+            container
+            for container in self.containers.values()
+            if all(
+                label.split("=")[0] in container["Labels"]
+                for label in filters.get("label", [])
+            )
+            and ("id" not in filters or container["Id"] in filters["id"])
+        ]
+
+    def inspect(self, container: dict) -> dict:
+        return {
+            "Id": container["Id"],
+            "Name": container["Names"][0],
+            "State": {
+                "Status": container["State"],
+                "StartedAt": "2024-01-01T00:00:00.000000000Z",
+            },
+            "Config": {"Labels": container["Labels"]},
+            "NetworkSettings": {
+                "Ports": {
+                    f"{port['PrivatePort']}/{port['Type']}": [
+                        {"HostIp": port["IP"], "HostPort": str(port["PublicPort"])}
+                    ]
+                    for port in container["Ports"]
+                }
+            },
+        }
+
+    @staticmethod
+    def stats(now: float, one_shot: bool) -> dict:
+        def cpu_stats(at: float) -> dict:
+            return {
+                "cpu_usage": {"total_usage": int(at * 1e8)},
+                "system_cpu_usage": int(at * 4e9),
+                "online_cpus": 4,
+            }
+
+        return {
+            "read": "2024-01-01T00:00:00.000000000Z",
+            "cpu_stats": cpu_stats(now),
+            "precpu_stats": {} if one_shot else cpu_stats(now - STREAM_INTERVAL),
+            "memory_stats": {
+                "usage": 100_000_000,
+                "limit": 1_000_000_000,
+                "failcnt": 0,
+                "stats": {
+                    "anon": 60_000_000,
+                    "file": 30_000_000,
+                    "inactive_file": 10_000_000,
+                },
+            },
+            "networks": {
+                "eth0": {
+                    "rx_bytes": 1000,
+                    "rx_packets": 10,
+                    "rx_errors": 0,
+                    "rx_dropped": 0,
+                    "tx_bytes": 2000,
+                    "tx_packets": 20,
+                    "tx_errors": 0,
+                    "tx_dropped": 0,
+                }
+            },
+            "blkio_stats": {
+                "io_service_bytes_recursive": [
+                    {"major": 8, "minor": 0, "op": "read", "value": 4096},
+                    {"major": 8, "minor": 0, "op": "write", "value": 8192},
+                ]
+            },
+        }
+
+    def df(self) -> dict:
+        return {
+            "Containers": [
+                {
+                    "Id": container["Id"],
+                    "SizeRootFs": 10_000_000,
+                    "SizeRw": 1000,
+                    "Mounts": container["Mounts"],
+                }
+                for container in self.containers.values()
+            ],
+            "Volumes": [
+                {"Name": f"volume-{index}", "UsageData": {"Size": 1_000_000}}
+                for index in range(len(self.containers))
+            ],
+        }
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def timed(fn: Callable[[], Any], repeat: int) -> float:
+    """
+    Get the median duration of calling `fn`
+    """
+
+    durations = list[float]()
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+
+    return percentile(durations, 0.5)
+
+
+def measure(scrapes: int, warmup: int) -> dict:
+    """
+    Run in the child process: start the service and scrape it
+    """
+
+    import prometheus_client
+    from fastapi.testclient import TestClient
+
+    import prometheus_docker_discovery
+
+    result = dict[str, Any]()
+
+    with TestClient(prometheus_docker_discovery.app) as service:
+        # the containers are listed by the events watchers once the service has started
+        for host in prometheus_docker_discovery.hosts:
+            host.inventory.seeded.wait()
+
+        for path in ("/metrics", "/targets"):
+            for _ in range(warmup):
+                # the background collector may need a moment to take the first snapshot
+                while service.get(path).status_code == 503:
+                    time.sleep(0.1)
+
+            durations = list[float]()
+            cpu_start = time.process_time()
+
+            for _ in range(scrapes):
+                start = time.perf_counter()
+                response = service.get(path)
+                durations.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+            result[path] = {
+                "p50": percentile(durations, 0.5),
+                "p99": percentile(durations, 0.99),
+                "cpu": (time.process_time() - cpu_start) / scrapes,
+                "size": len(response.content),
+            }
+
+        # the last snapshots are still in place to compare the exposition writer with the generic one
+        collector = prometheus_docker_discovery.snapshot_collector
+        registry = prometheus_docker_discovery.metrics_registry
+        body = collector.expose()
+
+        if body != prometheus_client.generate_latest(registry):
+            raise AssertionError("The exposition writer differs from generate_latest")
+
+        result["serialize"] = {
+            "series": sum(not line.startswith(b"#") for line in body.splitlines()),
+            "writer": timed(collector.expose, scrapes),
+            "generate_latest": timed(
+                partial(prometheus_client.generate_latest, registry), scrapes
+            ),
+        }
+
+    # worker processes of the service are reaped on its shutdown and only counted afterwards
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result["children_cpu"] = children.ru_utime + children.ru_stime
+    result["children_peak_rss"] = children.ru_maxrss * 1024
+
+    return result
+
+
+def benchmark(args: argparse.Namespace, containers: int, processes: int | None) -> dict:
+    docker = FakeDocker(containers, args.labels, args.latency)
+
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, "docker.sock")
+        docker.start(socket_path)
+
+        env = {
+            "DISCOVERY_METRICS_MODE": "on-demand",
+            "DISCOVERY_METRICS_MAX_AGE": "0",
+            **os.environ,
+            "DOCKER_HOST": f"unix://{socket_path}",
+        }
+
+        if args.engine:
+            env["DISCOVERY_STATS_ENGINE"] = args.engine
+
+        if processes is not None:
+            env["DISCOVERY_PROCESS_COUNT"] = str(processes)
+
+        try:
+            child = subprocess.run(
+                [
+                    sys.executable,
+                    __file__,
+                    "--child",
+                    f"--scrapes={args.scrapes}",
+                    f"--warmup={args.warmup}",
+                ],
+                env=env,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+        finally:
+            docker.stop()
+
+    return {
+        **json.loads(child.stdout.splitlines()[-1]),
+        "requests": docker.counts,
+        "connections": docker.connections,
+    }
+
+
+def report(containers: int, processes: int | None, result: dict, scrapes: int):
+    requests = ", ".join(
+        f"{endpoint}={count}" for endpoint, count in sorted(result["requests"].items())
+    )
+    title = f"{containers} containers"
+
+    if processes is not None:
+        title += f", {processes} processes"
+
+    print(f"{title}, peak RSS {result['peak_rss'] / 2**20:.1f} MiB")
+
+    for path in ("/metrics", "/targets"):
+        timings = result[path]
+        print(
+            f"  {path:<9} p50 {timings['p50'] * 1000:9.2f} ms  p99 {timings['p99'] * 1000:9.2f} ms"
+            f"  cpu {timings['cpu'] * 1000:9.2f} ms/scrape  {timings['size']} bytes"
+        )
+
+    serialize = result["serialize"]
+    print(
+        f"  serialize {serialize['series']} series: exposition writer {serialize['writer'] * 1000:.2f} ms,"
+        f" generate_latest {serialize['generate_latest'] * 1000:.2f} ms"
+    )
+
+    if result["children_cpu"]:
+        print(
+            f"  worker processes: cpu {result['children_cpu']:.2f} s in total,"
+            f" peak RSS {result['children_peak_rss'] / 2**20:.1f} MiB"
+        )
+
+    print(f"  daemon requests (startup, warm-up and {scrapes} scrapes): {requests}")
+    print(
+        f"  daemon connections: {result['connections']}"
+        f" for {sum(result['requests'].values())} requests"
+    )
+
+
+def parse_latency(value: str) -> tuple[str, float]:
+    endpoint, _, seconds = value.partition("=")
+
+    if endpoint not in ENDPOINTS:
+        raise argparse.ArgumentTypeError(
+            f"unknown endpoint {endpoint}, expected one of {', '.join(ENDPOINTS)}"
+        )
+
+    return endpoint, float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--containers", type=int, nargs="+", default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument(
+        "--labels",
+        type=int,
+        default=3,
+        help="number of target labels of every container",
+    )
+    parser.add_argument(
+        "--latency",
+        type=parse_latency,
+        action="append",
+        default=[],
+        metavar="ENDPOINT=SECONDS",
+        help=f"artificial latency of a daemon endpoint ({', '.join(ENDPOINTS)}), may be repeated",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["stream", "poll", "async", "cgroup", "process"],
+        help="DISCOVERY_STATS_ENGINE",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="+",
+        help="DISCOVERY_PROCESS_COUNT values of the process engine to compare",
+    )
+    parser.add_argument(
+        "--scrapes",
+        type=int,
+        default=20,
+        help="number of measured scrapes per endpoint",
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=2, help="number of scrapes before measuring"
+    )
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.scrapes, args.warmup)))
+        return
+
+    args.latency = dict(args.latency)
+
+    for containers in args.containers:
+        for processes in args.processes or [None]:
+            result = benchmark(args, containers, processes)
+            report(containers, processes, result, args.scrapes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Docker API helpers shared by the service and the worker processes of the process engine
+
+Spawned workers import this module instead of the service, so it must not have any
+side effects at import time: no Docker clients, worker pools or registries.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from docker import DockerClient
+from docker.errors import APIError, NotFound
+from docker.transport import UnixHTTPAdapter
+from docker.transport.unixconn import UnixHTTPConnectionPool
+from docker.utils import version_gte
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool
+
+
+def error_reason(error: BaseException) -> str:
+    if isinstance(
+        error, (TimeoutError, requests.exceptions.Timeout, httpx.TimeoutException)
+    ):
+        return "timeout"
+
+    if isinstance(error, NotFound) or (
+        isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 404
+    ):
+        return "not_found"
+
+    if isinstance(error, (APIError, httpx.HTTPStatusError)):
+        return "api_error"
+
+    return "error"
+
+
+class CountingUnixHTTPConnectionPool(UnixHTTPConnectionPool):
+    def _new_conn(self) -> Any:
+        # urllib3 counts the connections it opens itself, docker-py does not for unix sockets
+        self.num_connections += 1
+
+        return super()._new_conn()
+
+
+class UnixSocketAdapter(UnixHTTPAdapter):
+    """
+    Sends all requests to a unix socket over a single connection pool
+
+    docker-py keys the pools by the whole request URL, so every container got pools of its own
+    and beyond 25 of them each stats request opened a new connection.
+    """
+
+    def get_connection(self, url: str, proxies: Any = None) -> UnixHTTPConnectionPool:
+        with self.pools.lock:
+            if (pool := self.pools.get(self.socket_path)) is None:
+                pool = self.pools[self.socket_path] = CountingUnixHTTPConnectionPool(
+                    "http+docker://localhost",
+                    self.socket_path,
+                    self.timeout,
+                    maxsize=self.max_pool_size,
+                )
+
+        return pool
+
+
+def docker_client(url: str, pool_size: int, **kwargs: Any) -> DockerClient:
+    """
+    Create a client of the Docker daemon at `url` that keeps up to `pool_size` connections
+    open for reuse
+    """
+
+    client = DockerClient.from_env(
+        environment={**os.environ, "DOCKER_HOST": url},
+        use_ssh_client=urlparse(url).scheme == "ssh",
+        max_pool_size=pool_size,
+        **kwargs,
+    )
+    api = client.api
+
+    if urlparse(url).scheme in ("unix", "http+unix"):
+        api.get_adapter(api.base_url).close()
+        api.mount(
+            "http+docker://",
+            UnixSocketAdapter(
+                f"http+unix://{urlparse(url).path}",
+                api.timeout,
+                max_pool_size=pool_size,
+            ),
+        )
+    elif api.base_url.startswith("http://"):
+        # the default adapter of requests keeps only 10 connections per host
+        api.mount("http://", HTTPAdapter(pool_maxsize=pool_size))
+
+    return client
+
+
+def connection_pools(client: DockerClient) -> list[HTTPConnectionPool]:
+    pools = list[HTTPConnectionPool]()
+
+    for adapter in client.api.adapters.values():
+        containers = (
+            adapter.pools if hasattr(adapter, "pools") else adapter.poolmanager.pools
+        )
+        pools.extend(filter(None, map(containers.get, containers.keys())))
+
+    return pools
+
+
+# keys of the cgroup v1 and v2 memory.stat files used by `build_snapshot`
+MEMORY_STAT_KEYS = (
+    "cache",
+    "rss",
+    "total_inactive_file",
+    "inactive_file",
+    "anon",
+    "file",
+)
+NETWORK_KEYS = tuple(
+    f"{prefix}_{counter}"
+    for prefix in ("rx", "tx")
+    for counter in ("bytes", "packets", "errors", "dropped")
+)
+
+# the numbers of a stats payload used by `build_snapshot`, `None` where they are missing
+StatsValues = tuple[float | None, ...]
+
+
+def reduce_stats(stats: dict) -> StatsValues:
+    """
+    Reduce a stats payload to the numbers `build_snapshot` reads, so that the worker processes
+    send back a few floats per container instead of the whole payload
+    """
+
+    memory_stats = stats.get("memory_stats") or {}
+    memory_stat = memory_stats.get("stats") or {}
+    values = [
+        memory_stats.get("usage"),
+        memory_stats.get("limit"),
+        memory_stats.get("failcnt"),
+        *(memory_stat.get(key) for key in MEMORY_STAT_KEYS),
+    ]
+
+    for key in ("cpu_stats", "precpu_stats"):
+        cpu_stats = stats.get(key) or {}
+        values.append((cpu_stats.get("cpu_usage") or {}).get("total_usage"))
+        values.append(cpu_stats.get("system_cpu_usage"))
+        values.append(cpu_stats.get("online_cpus"))
+
+    if networks := stats.get("networks"):
+        values.extend(
+            sum(interface.get(key, 0) for interface in networks.values())
+            for key in NETWORK_KEYS
+        )
+    else:
+        values.extend(None for _ in NETWORK_KEYS)
+
+    if (
+        io_service_bytes := (stats.get("blkio_stats") or {}).get(
+            "io_service_bytes_recursive"
+        )
+    ) is not None:
+        read = written = 0
+
+        for entry in io_service_bytes:
+            if (op := entry.get("op", "").lower()) == "read":
+                read += entry.get("value", 0)
+            elif op == "write":
+                written += entry.get("value", 0)
+
+        values.extend((read, written))
+    else:
+        values.extend((None, None))
+
+    return tuple(values)
+
+
+def expand_stats(values: StatsValues) -> dict:
+    """
+    Rebuild a stats payload with only the numbers kept by `reduce_stats`
+    """
+
+    def present(pairs: Iterable[tuple[str, float | None]]) -> dict[str, float]:
+        return {key: value for key, value in pairs if value is not None}
+
+    usage, limit, failcnt, *rest = values
+    memory_stat = rest[: len(MEMORY_STAT_KEYS)]
+    cpu = rest[len(MEMORY_STAT_KEYS) : len(MEMORY_STAT_KEYS) + 6]
+    network = rest[len(MEMORY_STAT_KEYS) + 6 : -2]
+    read, written = rest[-2:]
+
+    stats = {
+        "memory_stats": {
+            **present((("usage", usage), ("limit", limit), ("failcnt", failcnt))),
+            "stats": present(zip(MEMORY_STAT_KEYS, memory_stat)),
+        },
+    }
+
+    for key, (total_usage, system_cpu_usage, online_cpus) in (
+        ("cpu_stats", cpu[:3]),
+        ("precpu_stats", cpu[3:]),
+    ):
+        stats[key] = present(
+            (("system_cpu_usage", system_cpu_usage), ("online_cpus", online_cpus))
+        )
+
+        if total_usage is not None:
+            stats[key]["cpu_usage"] = {"total_usage": total_usage}
+
+    if network[0] is not None:
+        # the interfaces are summed up already
+        stats["networks"] = {"all": dict(zip(NETWORK_KEYS, network))}
+
+    if read is not None:
+        stats["blkio_stats"] = {
+            "io_service_bytes_recursive": [
+                {"op": "read", "value": read},
+                {"op": "write", "value": written},
+            ]
+        }
+
+    return stats
+
+
+# state of a worker process, set up by `start_worker`
+process_clients = dict[str, DockerClient]()
+process_threads: ThreadPoolExecutor | None = None
+process_thread_count = 1
+process_timeout: float | None = None
+
+
+def start_worker(threads: int, timeout: float):
+    """
+    Initializer of the worker processes of the process engine
+    """
+
+    global process_threads, process_thread_count, process_timeout
+
+    # the threads are kept for the lifetime of the worker, like the shared worker pool of the service
+    process_threads = ThreadPoolExecutor(threads, thread_name_prefix="worker")
+    process_thread_count = threads
+    process_timeout = timeout
+
+
+def fetch_stats_chunk(
+    url: str, version: str, containers: list[tuple[str, bool]]
+) -> list[tuple[str, StatsValues | None, str | None, str | None]]:
+    """
+    Fetch the stats of a chunk of containers in a worker process of the process engine
+
+    Every container is given by its ID and whether it needs to be inspected,
+    every result is the container ID, its reduced stats, start time and the error reason.
+    """
+
+    assert process_threads is not None, "The worker process has not been started"
+
+    if (docker := process_clients.get(url)) is None:
+        docker = process_clients[url] = docker_client(
+            url, process_thread_count, version=version, timeout=process_timeout
+        )
+
+    one_shot = version_gte(version, "1.41")
+
+    def fetch(
+        container: tuple[str, bool],
+    ) -> tuple[str, StatsValues | None, str | None, str | None]:
+        container_id, needs_inspect = container
+
+        try:
+            started_at = None
+
+            if needs_inspect:
+                started_at = docker.api.inspect_container(container_id)["State"][
+                    "StartedAt"
+                ]
+
+            if one_shot:
+                stats = docker.api.stats(container_id, stream=False, one_shot=True)
+            else:
+                stats = docker.api.stats(container_id, stream=False)
+
+            return container_id, reduce_stats(stats), started_at, None
+        except Exception as error:
+            return container_id, None, None, error_reason(error)
+
+    # the requests of a chunk still wait for the daemon concurrently
+    return list(process_threads.map(fetch, containers))
@@ -1,12 +1,42 @@
-from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack, asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Iterable, cast
+from functools import partial
+from typing import Any, Callable, Coroutine, Iterable, TypeVar
+from urllib.parse import urlparse
 
+import httpx
 import prometheus_client
 from docker import DockerClient
-from docker.models.containers import Container
-from fastapi import FastAPI, Response
-from pydantic import BaseModel
+from docker.errors import NotFound
+from docker.utils import version_gte
+from fastapi import FastAPI, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+from prometheus_client.utils import floatToGoString
+from pydantic import BaseModel, TypeAdapter
+
+from docker_stats_worker import (
+    connection_pools,
+    docker_client,
+    error_reason,
+    expand_stats,
+    fetch_stats_chunk,
+    start_worker,
+)
 
 DISCOVERY_LABEL_PREFIX = "prometheus."
 JOB_LABEL = f"{DISCOVERY_LABEL_PREFIX}job"
@@ -14,24 +44,597 @@ TARGET_LABELS_PREFIX = f"{DISCOVERY_LABEL_PREFIX}labels."
 TARGET_PORT_LABEL = f"{DISCOVERY_LABEL_PREFIX}metrics.port"
 TARGET_HOST_LABEL = f"{DISCOVERY_LABEL_PREFIX}metrics.host"
 
+METRICS_MODE = os.environ.get("DISCOVERY_METRICS_MODE", "background")
+COLLECT_INTERVAL = float(os.environ.get("DISCOVERY_COLLECT_INTERVAL", "15"))
+METRICS_MAX_AGE = float(os.environ.get("DISCOVERY_METRICS_MAX_AGE", "5"))
+STATS_ENGINE = os.environ.get("DISCOVERY_STATS_ENGINE", "stream")
+STATS_STREAM_RETRY_DELAY = 5.0
+RESYNC_INTERVAL = float(os.environ.get("DISCOVERY_RESYNC_INTERVAL", "300"))
+DISK_USAGE_INTERVAL = float(os.environ.get("DISCOVERY_DISK_USAGE_INTERVAL", "300"))
+WORKER_POOL_SIZE = int(os.environ.get("DISCOVERY_WORKER_POOL_SIZE", "32"))
+COLLECT_CONCURRENCY = int(os.environ.get("DISCOVERY_COLLECT_CONCURRENCY", "16"))
+ASYNC_CONCURRENCY = int(os.environ.get("DISCOVERY_ASYNC_CONCURRENCY", "256"))
+PROCESS_COUNT = int(os.environ.get("DISCOVERY_PROCESS_COUNT", str(os.cpu_count() or 1)))
+STATS_TIMEOUT = float(os.environ.get("DISCOVERY_STATS_TIMEOUT", "10"))
+COLLECT_TIMEOUT = float(os.environ.get("DISCOVERY_COLLECT_TIMEOUT", "30"))
+CONNECT_TIMEOUT = float(os.environ.get("DISCOVERY_CONNECT_TIMEOUT", "5"))
+DOCKER_HOST = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock")
+DOCKER_HOSTS = os.environ.get("DISCOVERY_DOCKER_HOSTS", DOCKER_HOST)
+CGROUP_ROOT = os.environ.get("DISCOVERY_CGROUP_ROOT", "/sys/fs/cgroup")
+PROC_ROOT = os.environ.get("DISCOVERY_PROC_ROOT", "/proc")
+SHARD_INDEX = int(os.environ.get("DISCOVERY_SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.environ.get("DISCOVERY_SHARD_COUNT", "1"))
+EVENTS_RETRY_DELAY = 1.0
+EVENTS_MAX_RETRY_DELAY = 30.0
+
+if METRICS_MODE not in ("background", "on-demand", "stale-while-revalidate"):
+    raise ValueError(f"Unknown DISCOVERY_METRICS_MODE: {METRICS_MODE}")
+
+if STATS_ENGINE not in ("stream", "poll", "async", "cgroup", "process"):
+    raise ValueError(f"Unknown DISCOVERY_STATS_ENGINE: {STATS_ENGINE}")
+
+if not 0 <= SHARD_INDEX < SHARD_COUNT:
+    raise ValueError(
+        f"DISCOVERY_SHARD_INDEX must be between 0 and {SHARD_COUNT - 1}: {SHARD_INDEX}"
+    )
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
 
-app = FastAPI()
-client = DockerClient.from_env()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if STATS_ENGINE == "process":
+        process_engine.start()
+
+    for host in hosts:
+        host.start()
+
+    if STATS_ENGINE == "cgroup" and not cgroup_stats.available():
+        logger.warning(
+            "No cgroup v2 hierarchy found at %s, falling back to the Docker API",
+            CGROUP_ROOT,
+        )
+
+    yield
+
+    await asyncio.gather(*(run_in_threadpool(host.stop) for host in hosts))
+    process_engine.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 class PrometheusMetricsResponse(Response):
     media_type = prometheus_client.CONTENT_TYPE_LATEST
 
 
-def discover() -> Iterable[Container]:
-    containers = cast(list[Container], client.containers.list(all=True))
+internal_registry = prometheus_client.CollectorRegistry()
+
+phase_duration = prometheus_client.Histogram(
+    "docker_discovery_phase_duration_seconds",
+    "Duration of the individual phases of discovery and collection",
+    ["phase"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    registry=internal_registry,
+)
+
+collected_containers = prometheus_client.Gauge(
+    "docker_discovery_collected_containers",
+    "Number of containers processed by the last collection",
+    ["docker_host"],
+    registry=internal_registry,
+)
+
+response_size = prometheus_client.Histogram(
+    "docker_discovery_metrics_response_size_bytes",
+    "Size of the /metrics responses",
+    buckets=tuple(1024 * 4**exponent for exponent in range(10)),
+    registry=internal_registry,
+)
+
+
+class PeriodicTask(ABC):
+    """
+    Runs `run_once` in a background thread every `interval` seconds
+    """
+
+    name = "periodic-task"
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @abstractmethod
+    def run_once(self):
+        pass
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = time.monotonic()
+
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Task %s failed", self.name)
+
+            self._stopped.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+class WorkerPool:
+    """
+    Process-wide thread pool shared by all collections
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.queued = 0
+        self.active = 0
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="worker")
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        with self._lock:
+            self.queued += 1
+
+        future = self._executor.submit(self._call, time.monotonic(), fn, *args)
+        future.add_done_callback(self._dequeue_cancelled)
+
+        return future
+
+    def run(
+        self,
+        fn: Callable[[Any], Any],
+        items: Iterable[Any],
+        concurrency: int,
+        timeout: float | None = None,
+    ) -> list[Future | None]:
+        """
+        Call `fn` for every item with at most `concurrency` calls in flight and wait for all of them,
+        but no longer than `timeout` seconds
+
+        Items that could not be started before the timeout get `None` instead of a future.
+        """
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        semaphore = threading.BoundedSemaphore(concurrency)
+        futures = list[Future | None]()
+
+        def remaining() -> float | None:
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        for item in items:
+            if not semaphore.acquire(timeout=remaining()):
+                futures.append(None)
+                continue
+
+            future = self.submit(fn, item)
+            future.add_done_callback(lambda _: semaphore.release())
+            futures.append(future)
+
+        wait([future for future in futures if future is not None], timeout=remaining())
+
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+        return futures
+
+    def _dequeue_cancelled(self, future: Future):
+        # only tasks that are still queued can be cancelled, `_call` never runs for them
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    def _call(self, submitted: float, fn: Callable[..., Any], *args: Any) -> Any:
+        worker_pool_wait.observe(time.monotonic() - submitted)
+
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+worker_pool = WorkerPool(WORKER_POOL_SIZE)
+
+worker_pool_wait = prometheus_client.Histogram(
+    "docker_discovery_worker_pool_wait_seconds",
+    "Time tasks spend waiting for a free worker",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=internal_registry,
+)
+
+prometheus_client.Gauge(
+    "docker_discovery_worker_pool_size",
+    "Number of threads in the shared worker pool",
+    registry=internal_registry,
+).set(worker_pool.size)
+
+prometheus_client.Gauge(
+    "docker_discovery_worker_pool_queue_depth",
+    "Number of tasks waiting for a worker",
+    registry=internal_registry,
+).set_function(lambda: worker_pool.queued)
+
+prometheus_client.Gauge(
+    "docker_discovery_worker_pool_active_workers",
+    "Number of workers currently running a task",
+    registry=internal_registry,
+).set_function(lambda: worker_pool.active)
+
+
+@dataclass
+class ContainerInfo:
+    """
+    Container as reported by the sparse container listing, i.e. without a per-container inspect
+    """
+
+    id: str
+    name: str
+    labels: dict[str, str]
+    status: str
+    image: str
+    image_id: str
+    ports: dict[str, list[dict[str, str]]]
+    started_at: datetime | None = None
+
+    @classmethod
+    def from_summary(cls, summary: dict) -> "ContainerInfo":
+        ports = dict[str, list[dict[str, str]]]()
+
+        # only published ports are reported with a host binding, just like in `inspect`
+        for port in summary.get("Ports") or []:
+            if "PublicPort" not in port:
+                continue
+
+            ports.setdefault(f"{port['PrivatePort']}/{port['Type']}", []).append(
+                {"HostIp": port.get("IP", ""), "HostPort": str(port["PublicPort"])}
+            )
+
+        names = summary.get("Names") or []
+
+        return cls(
+            id=summary["Id"],
+            name=names[0].lstrip("/") if names else "",
+            labels=summary.get("Labels") or {},
+            status=summary.get("State", ""),
+            image=summary.get("Image", ""),
+            image_id=summary.get("ImageID", ""),
+            ports=ports,
+        )
+
+    def needs_inspect(self) -> bool:
+        return self.status == "running" and self.started_at is None
+
+    def update(self, attrs: dict):
+        """
+        Fill in the fields that are only available from `inspect`
+        """
+
+        if started_at := attrs.get("State", {}).get("StartedAt"):
+            self.started_at = datetime.fromisoformat(started_at).astimezone(
+                timezone.utc
+            )
+
+
+def shard(container_id: str, shard_count: int) -> int:
+    """
+    Jump consistent hash of the container ID, which moves only `1 / shard_count` of the containers
+    when a shard is added
+    """
+
+    key = int.from_bytes(
+        hashlib.blake2b(container_id.encode(), digest_size=8).digest(), "big"
+    )
+    bucket, candidate = -1, 0
+
+    while candidate < shard_count:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+
+    return bucket
+
+
+discover_errors = prometheus_client.Counter(
+    "docker_discovery_discover_errors",
+    "Number of times the containers of a Docker host could not be listed",
+    ["docker_host", "reason"],
+    registry=internal_registry,
+)
+
+
+class Inventory:
+    """
+    In-memory view of the labeled containers, seeded by a full listing and then kept current
+    from the Docker events API
+    """
+
+    REFRESH_ACTIONS = {
+        "create",
+        "start",
+        "restart",
+        "stop",
+        "die",
+        "kill",
+        "pause",
+        "unpause",
+        "rename",
+        "update",
+    }
+    # actions after which the container has a new start time, or none
+    START_ACTIONS = {"start", "restart", "die"}
+
+    def __init__(
+        self,
+        client: Callable[[], DockerClient],
+        events: Callable[[], Iterable[dict]] | None = None,
+        resync_interval: float = RESYNC_INTERVAL,
+        name: str = "",
+    ):
+        self._client = client
+        self._name = name
+        self._events = events or self._docker_events
+        self._resync_interval = resync_interval
+        self._containers = dict[str, ContainerInfo]()
+        self.generation = 0
+        self._lock = threading.Lock()
+        # set once the containers have been listed
+        self.seeded = threading.Event()
+        self._stopped = threading.Event()
+        self._stream: Iterable[dict] | None = None
+        # number of the events subscription, and the one the last listing was made during
+        self._subscription = 0
+        self._listed_subscription: int | None = None
+        self._threads = list[threading.Thread]()
+
+    def start(self):
+        self._stopped.clear()
+        self._threads = [
+            threading.Thread(target=self._watch, name="inventory-events", daemon=True),
+            threading.Thread(target=self._resync, name="inventory-resync", daemon=True),
+        ]
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if (close := getattr(self._stream, "close", None)) is not None:
+            close()
+
+        for thread in self._threads:
+            thread.join()
+
+        self._threads = []
+
+    def containers(self) -> list[ContainerInfo]:
+        """
+        Current containers, none until the watcher has listed them, so that requests never wait
+        for the daemon
+        """
+
+        with self._lock:
+            return list(self._containers.values())
+
+    def resync(self):
+        """
+        Replace the inventory with a full listing of the labeled containers
+        """
+
+        subscription = self._subscription if self._stream is not None else None
+        containers = self._list(filters={"label": JOB_LABEL})
+
+        with self._lock:
+            # the listing has no start times, so they are only kept while no event can have
+            # been missed since the previous listing, a restart would have cleared them
+            continuous = (
+                subscription is not None and subscription == self._listed_subscription
+            )
+            self._listed_subscription = subscription
+
+            for container in containers:
+                previous = self._containers.get(container.id)
+
+                if (
+                    continuous
+                    and previous is not None
+                    and previous.status == container.status
+                ):
+                    container.started_at = previous.started_at
+
+            inventory = {container.id: container for container in containers}
+
+            if inventory != self._containers:
+                self._containers = inventory
+                self.generation += 1
+
+        self.seeded.set()
+
+    def refresh(self, container_id: str, restarted: bool = False):
+        containers = self._list(filters={"label": JOB_LABEL, "id": container_id})
+
+        with self._lock:
+            if containers:
+                container = containers[0]
+                previous = self._containers.get(container_id)
+
+                if (
+                    not restarted
+                    and previous is not None
+                    and previous.status == container.status
+                ):
+                    container.started_at = previous.started_at
+
+                if previous != container:
+                    self._containers[container_id] = container
+                    self.generation += 1
+            elif self._containers.pop(container_id, None) is not None:
+                self.generation += 1
+
+    def started_at(self, container: ContainerInfo) -> datetime | None:
+        """
+        Start time of a running container, inspected only once per container start
+        """
+
+        if container.needs_inspect():
+            try:
+                container.update(self._client().api.inspect_container(container.id))
+            except NotFound:
+                return None
+
+        return container.started_at
+
+    def _list(self, filters: dict) -> list[ContainerInfo]:
+        # the sparse listing avoids docker-py inspecting every single container
+        with phase_duration.labels("list").time():
+            summaries = self._client().api.containers(all=True, filters=filters)
+
+        return [
+            ContainerInfo.from_summary(summary)
+            for summary in summaries
+            if JOB_LABEL in (summary.get("Labels") or {})
+            and shard(summary["Id"], SHARD_COUNT) == SHARD_INDEX
+        ]
+
+    def apply(self, event: dict):
+        """
+        Update the inventory according to a single Docker event
+        """
+
+        if event.get("Type", "container") != "container":
+            return
+
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+        action = (event.get("Action") or event.get("status") or "").split(":")[0]
+
+        # containers of the other shards are never listed by this replica
+        if not container_id or shard(container_id, SHARD_COUNT) != SHARD_INDEX:
+            return
+
+        if action == "destroy":
+            with self._lock:
+                if self._containers.pop(container_id, None) is not None:
+                    self.generation += 1
+        elif action in self.REFRESH_ACTIONS:
+            self.refresh(container_id, restarted=action in self.START_ACTIONS)
+
+    def _docker_events(self) -> Iterable[dict]:
+        return self._client().events(
+            decode=True, filters={"type": "container", "label": JOB_LABEL}
+        )
+
+    def _watch(self):
+        retry_delay = EVENTS_RETRY_DELAY
+
+        while not self._stopped.is_set():
+            try:
+                self._stream = self._events()
+                self._subscription += 1
+
+                # events that happened before the subscription are covered by the listing
+                self.resync()
+                retry_delay = EVENTS_RETRY_DELAY
+
+                for event in self._stream:
+                    if self._stopped.is_set():
+                        break
 
-    for container in containers:
-        if JOB_LABEL in container.labels:
-            yield container
+                    self.apply(event)
+            except Exception as error:
+                if self._stopped.is_set():
+                    break
 
+                logger.warning("Docker events stream failed", exc_info=True)
+                discover_errors.labels(self._name, error_reason(error)).inc()
+            finally:
+                self._stream = None
 
-def target_labels(container: Container) -> dict[str, str]:
+            self._stopped.wait(retry_delay)
+            retry_delay = min(retry_delay * 2, EVENTS_MAX_RETRY_DELAY)
+
+    def _resync(self):
+        while not self._stopped.wait(self._resync_interval):
+            try:
+                self.resync()
+            except Exception as error:
+                logger.warning("Inventory resync failed", exc_info=True)
+                discover_errors.labels(self._name, error_reason(error)).inc()
+
+
+class DiskUsage(PeriodicTask):
+    """
+    Cached result of `client.df()`, which makes the daemon walk every container layer and volume,
+    refreshed on its own interval so that it never delays the other metrics
+    """
+
+    name = "disk-usage"
+
+    def __init__(self, client: Callable[[], DockerClient], interval: float):
+        super().__init__(interval)
+        self._client = client
+        self._containers = dict[str, dict]()
+        self._volumes = list[dict]()
+        self.updated_at: float | None = None
+
+    def run_once(self):
+        with phase_duration.labels("disk_usage").time():
+            info = self._client().df()
+
+        self._containers = {
+            container["Id"]: container for container in info.get("Containers") or []
+        }
+        self._volumes = info.get("Volumes") or []
+        self.updated_at = time.time()
+
+    def container(self, container_id: str) -> dict | None:
+        return self._containers.get(container_id)
+
+    def volumes(self) -> list[dict]:
+        return self._volumes
+
+    def age(self) -> float:
+        if self.updated_at is None:
+            return float("nan")
+
+        return time.time() - self.updated_at
+
+
+disk_usage_age = prometheus_client.Gauge(
+    "docker_discovery_disk_usage_age_seconds",
+    "Age of the cached Docker disk usage data",
+    ["docker_host"],
+    registry=internal_registry,
+)
+
+
+def discover() -> Iterable[tuple["DockerHost", ContainerInfo]]:
+    for host in hosts:
+        for container in host.inventory.containers():
+            yield host, container
+
+
+def target_labels(container: ContainerInfo) -> dict[str, str]:
     result = dict[str, str]()
 
     for label_name, label_value in container.labels.items():
@@ -49,11 +652,12 @@ class DiscoveredTarget(BaseModel):
     labels: dict[str, str]
 
 
-@app.get("/targets", response_model=list[DiscoveredTarget])
-def get_targets():
+def build_targets(
+    containers: Iterable[tuple["DockerHost", ContainerInfo]],
+) -> list[DiscoveredTarget]:
     result = list[DiscoveredTarget]()
 
-    for container in discover():
+    for docker_host, container in containers:
         if TARGET_PORT_LABEL not in container.labels:
             continue
 
@@ -69,6 +673,10 @@ def get_targets():
             if not host:
                 host = port_spec[0]["HostIp"]
 
+                # ports published on all interfaces of a remote daemon are reached through its address
+                if host in ("0.0.0.0", "::") and docker_host.address:
+                    host = docker_host.address
+
         if not host or not port:
             continue
 
@@ -77,6 +685,7 @@ def get_targets():
             labels={
                 "job": container.labels[JOB_LABEL],
                 "container_name": container.name or "",
+                "docker_host": docker_host.name,
                 **target_labels(container),
             },
         )
@@ -86,145 +695,1541 @@ def get_targets():
     return result
 
 
-@app.get("/metrics", response_class=PrometheusMetricsResponse)
-def get_metrics():
+class TargetsCache:
     """
-    Retrieve Prometheus metrics
+    Serialized `/targets` response, rebuilt only when the inventory changes
     """
 
-    registry = prometheus_client.CollectorRegistry()
-    label_names = ["job", "container_name", "image", "image_id", "container_id"]
-    now = datetime.now(timezone.utc)
+    def __init__(self):
+        self._generation: tuple[int, ...] | None = None
+        self._body = b""
+        self._etag = ""
+        self._adapter = TypeAdapter(list[DiscoveredTarget])
+        self._lock = threading.Lock()
 
-    containers = list(discover())
+    def get(self) -> tuple[bytes, str]:
+        generation = tuple(host.inventory.generation for host in hosts)
 
-    info = client.df()
+        with self._lock:
+            if generation == self._generation:
+                return self._body, self._etag
 
-    containers_df = {container["Id"]: container for container in info["Containers"]}
+        # the response is built outside the lock, a concurrent rebuild only repeats the work
+        body = self._adapter.dump_json(build_targets(discover()))
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
 
-    for container in containers:
-        for label in target_labels(container).keys():
-            if label not in label_names:
-                label_names.append(label)
+        with self._lock:
+            self._body, self._etag, self._generation = body, etag, generation
 
-    container_memory_usage = prometheus_client.Gauge(
-        "docker_container_memory_usage_bytes",
-        "Container memory usage (without caches)",
-        label_names,
-        registry=registry,
-    )
+        return body, etag
 
-    container_cpu_usage = prometheus_client.Gauge(
-        "docker_container_cpu_usage_percent",
-        "Container CPU usage percent (not divided by number of CPU cores)",
-        label_names,
-        registry=registry,
-    )
 
-    container_uptime = prometheus_client.Gauge(
-        "docker_container_uptime_seconds",
-        "Container uptime",
-        label_names,
-        registry=registry,
-    )
+targets_cache = TargetsCache()
 
-    container_rootfs_size = prometheus_client.Gauge(
-        "docker_container_rootfs_size_bytes",
-        "Container rootfs size in bytes",
-        label_names,
-        registry=registry,
-    )
 
-    container_size_on_disk = prometheus_client.Gauge(
-        "docker_container_disk_size_bytes",
-        "Container size on disk in bytes",
-        label_names,
-        registry=registry,
-    )
+@app.get("/targets", response_model=list[DiscoveredTarget])
+async def get_targets(request: Request):
+    # rebuilding the response validates and serializes every target
+    body, etag = await run_in_threadpool(targets_cache.get)
+    if_none_match = request.headers.get("if-none-match", "")
 
-    container_mount_count = prometheus_client.Gauge(
-        "docker_container_mount_count",
-        "Number of container mounts",
-        label_names,
-        registry=registry,
-    )
+    if if_none_match == "*" or etag in map(str.strip, if_none_match.split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
 
-    volume_size = prometheus_client.Gauge(
-        "docker_volume_size_bytes",
-        "Size of a volume in bytes.",
-        ["volume_id"],
-        registry=registry,
-    )
+    return Response(body, media_type="application/json", headers={"ETag": etag})
 
-    def fetch_stats(container: Container):
-        stats = container.stats(stream=False)
 
-        labels = target_labels(container)
-        metric_labels = dict[str, str]()
+class StatsStreams:
+    """
+    Keeps a streaming stats subscription open for every running container and remembers
+    the latest frame received from each of them
+    """
 
-        for label in label_names:
-            if label == "job":
-                metric_labels[label] = container.labels[JOB_LABEL]
-            elif label == "container_name":
-                metric_labels[label] = container.name or ""
-            elif label == "image":
-                metric_labels[label] = containers_df[container.id].get("Image", "")
-            elif label == "image_id":
-                metric_labels[label] = containers_df[container.id].get("ImageID", "")
-            elif label == "container_id":
-                metric_labels[label] = container.id or "unknown-container-id"
-            else:
-                metric_labels[label] = labels.get(label, "")
+    def __init__(self, client: Callable[[], DockerClient]):
+        self._client = client
+        self._latest = dict[str, dict]()
+        self._streams = dict[str, threading.Event]()
+        self._lock = threading.Lock()
 
-        container_memory_usage.labels(**metric_labels).set(
-            stats["memory_stats"].get("usage", 0)
-            - stats["memory_stats"].get("stats", {}).get("cache", 0)
-        )
+    def sync(self, containers: Iterable[ContainerInfo]):
+        """
+        Open streams for newly discovered containers and close streams of the ones that are gone
+        """
 
-        cpu_delta = (
-            stats["cpu_stats"]["cpu_usage"]["total_usage"]
-            - stats["precpu_stats"]["cpu_usage"]["total_usage"]
-        )
-        system_cpu_delta = stats["cpu_stats"].get("system_cpu_usage", 0) - stats[
-            "precpu_stats"
-        ].get("system_cpu_usage", 0)
-
-        container_cpu_usage.labels(**metric_labels).set(
-            (cpu_delta / system_cpu_delta) * stats["cpu_stats"]["online_cpus"] * 100.0
-            if system_cpu_delta > 0
-            else 0
-        )
+        container_ids = {container.id for container in containers}
+
+        with self._lock:
+            for container_id in container_ids - self._streams.keys():
+                stopped = threading.Event()
+                self._streams[container_id] = stopped
+                threading.Thread(
+                    target=self._follow,
+                    args=(container_id, stopped),
+                    name=f"stats-{container_id[:12]}",
+                    daemon=True,
+                ).start()
+
+            for container_id in self._streams.keys() - container_ids:
+                self._streams.pop(container_id).set()
+                self._latest.pop(container_id, None)
 
-        if container.status == "running" and container.attrs:
-            started_at = container.attrs.get("State", {}).get("StartedAt")
-            if started_at:
-                container_uptime.labels(**metric_labels).set(
-                    (
-                        now
-                        - datetime.fromisoformat(started_at).astimezone(timezone.utc)
-                    ).total_seconds()
+    def latest(self, container_id: str) -> dict | None:
+        return self._latest.get(container_id)
+
+    def close(self):
+        self.sync([])
+
+    def _follow(self, container_id: str, stopped: threading.Event):
+        while not stopped.is_set():
+            try:
+                stream = self._client().api.stats(
+                    container_id, stream=True, decode=True
                 )
-        else:
-            container_uptime.labels(**metric_labels).set(0)
 
-        container_rootfs_size.labels(**metric_labels).set(
-            containers_df[container.id]["SizeRootFs"]
-        )
+                try:
+                    for frame in stream:
+                        with self._lock:
+                            if stopped.is_set():
+                                break
 
-        if "SizeRw" in containers_df[container.id]:
-            container_size_on_disk.labels(**metric_labels).set(
-                containers_df[container.id]["SizeRw"]
-            )
+                            self._latest[container_id] = frame
+                finally:
+                    stream.close()
+            except NotFound:
+                return
+            except Exception:
+                logger.warning(
+                    "Stats stream of container %s failed", container_id, exc_info=True
+                )
+
+            stopped.wait(STATS_STREAM_RETRY_DELAY)
+
+
+class CgroupStats:
+    """
+    Reads container statistics straight from the cgroup v2 hierarchy, which takes microseconds
+    instead of a stats round-trip to the Docker daemon
+
+    The statistics are returned in the format of the Docker stats API.
+    """
+
+    # cgroup paths of containers with the systemd and cgroupfs cgroup drivers
+    CONTAINER_PATHS = ("system.slice/docker-{}.scope", "docker/{}")
+
+    def __init__(self, root: str, proc_root: str):
+        self._root = root
+        self._proc_root = proc_root
+        self._paths = dict[str, str]()
+        self._clock_ticks = os.sysconf("SC_CLK_TCK")
+
+    def available(self) -> bool:
+        return os.path.isfile(os.path.join(self._root, "cgroup.controllers"))
+
+    def read(self, container_id: str) -> dict | None:
+        """
+        Get the stats of a running container, `None` when its cgroup cannot be read
+        """
 
-        container_mount_count.labels(**metric_labels).set(
-            len(containers_df[container.id].get("Mounts", []))
+        if (path := self._container_path(container_id)) is None:
+            return None
+
+        try:
+            cpu_stat = self._read_keyed(os.path.join(path, "cpu.stat"))
+            memory_stat = self._read_keyed(os.path.join(path, "memory.stat"))
+            memory_events = self._read_keyed(os.path.join(path, "memory.events"))
+            memory_usage = int(self._read(os.path.join(path, "memory.current")))
+            memory_limit = self._read(os.path.join(path, "memory.max"))
+            io_stat = self._read(os.path.join(path, "io.stat"))
+            online_cpus = self._online_cpus(path)
+            system_cpu_usage = self._system_cpu_usage()
+        except FileNotFoundError:
+            # the container has stopped since it was last seen
+            self._paths.pop(container_id, None)
+            return None
+
+        cpu_stats = {
+            "cpu_usage": {"total_usage": cpu_stat.get("usage_usec", 0) * 1000},
+            "system_cpu_usage": system_cpu_usage,
+            "online_cpus": online_cpus,
+        }
+        # like the Docker daemon, the OOM events of memory.events are reported as failcnt
+        memory_stats = {
+            "usage": memory_usage,
+            "stats": memory_stat,
+            "failcnt": memory_events.get("oom", 0),
+        }
+
+        if memory_limit != "max":
+            memory_stats["limit"] = int(memory_limit)
+
+        return {
+            "cpu_stats": cpu_stats,
+            "memory_stats": memory_stats,
+            "blkio_stats": {"io_service_bytes_recursive": self._parse_io(io_stat)},
+        }
+
+    def prune(self, container_ids: set[str]):
+        for container_id in self._paths.keys() - container_ids:
+            self._paths.pop(container_id, None)
+
+    def _container_path(self, container_id: str) -> str | None:
+        if (path := self._paths.get(container_id)) is not None:
+            return path
+
+        for pattern in self.CONTAINER_PATHS:
+            path = os.path.join(self._root, pattern.format(container_id))
+
+            if os.path.isdir(path):
+                self._paths[container_id] = path
+                return path
+
+        return None
+
+    def _online_cpus(self, path: str) -> int:
+        try:
+            cpus = self._read(os.path.join(path, "cpuset.cpus.effective"))
+        except FileNotFoundError:
+            return os.cpu_count() or 1
+
+        count = 0
+
+        for cpu_range in filter(None, cpus.split(",")):
+            first, _, last = cpu_range.partition("-")
+            count += int(last or first) - int(first) + 1
+
+        return count or os.cpu_count() or 1
+
+    def _system_cpu_usage(self) -> int:
+        with open(os.path.join(self._proc_root, "stat")) as stat:
+            for line in stat:
+                if line.startswith("cpu "):
+                    ticks = sum(int(value) for value in line.split()[1:8])
+                    return ticks * 1_000_000_000 // self._clock_ticks
+
+        return 0
+
+    @staticmethod
+    def _parse_io(io_stat: str) -> list[dict]:
+        result = list[dict]()
+
+        for line in io_stat.splitlines():
+            device, *fields = line.split()
+            major, _, minor = device.partition(":")
+            values = dict(field.split("=", 1) for field in fields)
+
+            for op, key in (("read", "rbytes"), ("write", "wbytes")):
+                if key in values:
+                    result.append(
+                        {
+                            "major": int(major),
+                            "minor": int(minor),
+                            "op": op,
+                            "value": int(values[key]),
+                        }
+                    )
+
+        return result
+
+    @staticmethod
+    def _read(path: str) -> str:
+        with open(path) as file:
+            return file.read().strip()
+
+    @classmethod
+    def _read_keyed(cls, path: str) -> dict[str, int]:
+        result = dict[str, int]()
+
+        for line in cls._read(path).splitlines():
+            key, _, value = line.partition(" ")
+            result[key] = int(value)
+
+        return result
+
+
+cgroup_stats = CgroupStats(CGROUP_ROOT, PROC_ROOT)
+
+
+collect_errors = prometheus_client.Counter(
+    "docker_discovery_collect_errors",
+    "Number of containers whose data could not be collected",
+    ["docker_host", "container_name", "reason"],
+    registry=internal_registry,
+)
+
+
+def record_error(
+    host: "DockerHost",
+    container: ContainerInfo,
+    reason: str,
+    error: BaseException | None,
+):
+    collect_errors.labels(
+        docker_host=host.name, container_name=container.name, reason=reason
+    ).inc()
+    logger.debug(
+        "Collecting container %s on %s failed: %s",
+        container.name,
+        host.name,
+        reason,
+        exc_info=error,
+    )
+
+
+class CpuTracker:
+    """
+    Remembers the last CPU counters of every container, so that the CPU usage can be computed
+    between two collections instead of waiting for the daemon to sample it twice per request
+    """
+
+    def __init__(self):
+        self._previous = dict[str, dict]()
+        self._lock = threading.Lock()
+
+    def track(self, stats: dict[str, dict | None], container_ids: set[str]):
+        """
+        Fill in the missing `precpu_stats` of the samples and remember their `cpu_stats`
+        """
+
+        with self._lock:
+            for container_id, sample in stats.items():
+                if not sample or not sample.get("cpu_stats", {}).get(
+                    "system_cpu_usage"
+                ):
+                    continue
+
+                if not sample.get("precpu_stats", {}).get("system_cpu_usage"):
+                    sample["precpu_stats"] = self._previous.get(container_id, {})
+
+                self._previous[container_id] = sample["cpu_stats"]
+
+            for container_id in self._previous.keys() - container_ids:
+                del self._previous[container_id]
+
+
+def poll_stats(host: "DockerHost", container_id: str) -> dict:
+    if version_gte(host.client.api.api_version, "1.41"):
+        # the CPU usage is computed against the previous collection,
+        # so there is no need to wait for the daemon to sample it twice
+        return host.stats_client.api.stats(container_id, stream=False, one_shot=True)
+
+    return host.stats_client.api.stats(container_id, stream=False)
+
+
+def container_stats(host: "DockerHost", container: ContainerInfo) -> dict | None:
+    """
+    Get the latest stats of the container, `None` when none are available yet
+    """
+
+    if STATS_ENGINE == "poll":
+        return poll_stats(host, container.id)
+
+    if container.status != "running":
+        return {}
+
+    if STATS_ENGINE == "stream":
+        return host.stats_streams.latest(container.id)
+
+    if host.local and (stats := cgroup_stats.read(container.id)) is not None:
+        return stats
+
+    # fall back to the Docker API for containers whose cgroup is not visible
+    return poll_stats(host, container.id)
+
+
+def fetch_container(host: "DockerHost", container: ContainerInfo) -> dict | None:
+    """
+    Fetch everything about the container that requires a call to the Docker daemon
+    """
+
+    host.inventory.started_at(container)
+
+    with phase_duration.labels("stats").time():
+        return container_stats(host, container)
+
+
+def fetch_all(
+    host: "DockerHost", containers: list[ContainerInfo]
+) -> dict[str, dict | None]:
+    if STATS_ENGINE == "stream":
+        host.stats_streams.sync(
+            container for container in containers if container.status == "running"
         )
 
-    for volume in info["Volumes"]:
-        volume_size.labels(volume_id=volume["Name"]).set(volume["UsageData"]["Size"])
+    if STATS_ENGINE == "cgroup" and host.local:
+        cgroup_stats.prune({container.id for container in containers})
 
-    with ThreadPoolExecutor(64) as pool:
-        for container in containers:
-            pool.submit(fetch_stats, container)
+    if STATS_ENGINE == "process":
+        return process_engine.fetch_all(host, containers)
+
+    futures = worker_pool.run(
+        partial(fetch_container, host), containers, COLLECT_CONCURRENCY, COLLECT_TIMEOUT
+    )
+    stats = dict[str, dict | None]()
 
-    return PrometheusMetricsResponse(prometheus_client.generate_latest(registry))
+    for container, future in zip(containers, futures):
+        if future is None or future.cancelled() or not future.done():
+            record_error(host, container, "timeout", None)
+        elif (error := future.exception()) is not None:
+            record_error(host, container, error_reason(error), error)
+        else:
+            stats[container.id] = future.result()
+
+    return stats
+
+
+class AsyncDockerClient:
+    """
+    Minimal asyncio client of the Docker Engine API
+    """
+
+    def __init__(self, base_url: str, version: str, max_connections: int):
+        url = urlparse(base_url)
+        # keep every connection alive, httpx only keeps 20 by default; the limits of
+        # the client are ignored once it is given a transport
+        limits = httpx.Limits(
+            max_connections=max_connections, max_keepalive_connections=max_connections
+        )
+
+        if url.scheme in ("unix", "http+unix"):
+            transport = httpx.AsyncHTTPTransport(uds=url.path, limits=limits)
+            origin = "http://docker"
+        elif url.scheme in ("tcp", "http"):
+            transport = httpx.AsyncHTTPTransport(limits=limits)
+            origin = f"http://{url.netloc}"
+        else:
+            raise ValueError(
+                f"Unsupported Docker host for the async client: {base_url}"
+            )
+
+        self._http = httpx.AsyncClient(
+            base_url=f"{origin}/v{version}",
+            transport=transport,
+            timeout=STATS_TIMEOUT,
+        )
+
+    async def inspect_container(self, container_id: str) -> dict:
+        return await self._get(f"/containers/{container_id}/json")
+
+    async def stats(self, container_id: str, one_shot: bool = False) -> dict:
+        params = {"stream": "false"}
+
+        if one_shot:
+            params["one-shot"] = "true"
+
+        return await self._get(f"/containers/{container_id}/stats", **params)
+
+    async def aclose(self):
+        await self._http.aclose()
+
+    async def _get(self, path: str, **params: str) -> Any:
+        response = await self._http.get(path, params=params)
+        response.raise_for_status()
+
+        return response.json()
+
+
+class AsyncEngine:
+    """
+    Fans out the per-container Docker API calls with asyncio on a dedicated event loop,
+    so that concurrent requests do not need a thread each
+    """
+
+    def __init__(self, host: "DockerHost", concurrency: int):
+        self._host = host
+        self._concurrency = concurrency
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._client: AsyncDockerClient | None = None
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever,
+            name=f"async-engine-{self._host.name}",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._loop is None or self._thread is None:
+            return
+
+        if self._client is not None:
+            self.submit(self._client.aclose()).result()
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = self._thread = self._client = None
+
+    def submit(self, coroutine: Coroutine[Any, Any, T]) -> Future[T]:
+        assert self._loop is not None, "The async engine is not running"
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    async def fetch_all(
+        self, containers: list[ContainerInfo]
+    ) -> dict[str, dict | None]:
+        if self._client is None:
+            # the API version is only known once the daemon has been reached
+            self._client = AsyncDockerClient(
+                self._host.url, self._host.client.api.api_version, self._concurrency
+            )
+
+        docker = self._client
+        semaphore = asyncio.Semaphore(self._concurrency)
+        one_shot = version_gte(self._host.client.api.api_version, "1.41")
+
+        async def fetch_container(container: ContainerInfo) -> dict:
+            if container.needs_inspect():
+                container.update(await docker.inspect_container(container.id))
+
+            with phase_duration.labels("stats").time():
+                return await docker.stats(container.id, one_shot)
+
+        async def fetch(container: ContainerInfo) -> dict:
+            if container.status != "running":
+                return {}
+
+            async with semaphore:
+                return await asyncio.wait_for(fetch_container(container), STATS_TIMEOUT)
+
+        tasks = [asyncio.ensure_future(fetch(container)) for container in containers]
+
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=COLLECT_TIMEOUT)
+
+            for task in pending:
+                task.cancel()
+
+        stats = dict[str, dict | None]()
+
+        for container, task in zip(containers, tasks):
+            # cancelled tasks only finish once the event loop gets to them
+            if task.cancelled() or not task.done():
+                record_error(self._host, container, "timeout", None)
+            elif (error := task.exception()) is not None:
+                record_error(self._host, container, error_reason(error), error)
+            else:
+                stats[container.id] = task.result()
+
+        return stats
+
+
+class ProcessEngine:
+    """
+    Spreads the per-container Docker API calls and the decoding of their responses over worker
+    processes, so that collecting many containers is not limited to the single core the GIL allows
+
+    Only the numbers of the stats used for the metrics are sent back to the service.
+    """
+
+    def __init__(self, processes: int):
+        self._processes = processes
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(self):
+        # worker processes are spawned, as forking a process with running threads is not safe
+        self._executor = ProcessPoolExecutor(
+            self._processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_worker,
+            initargs=(max(1, COLLECT_CONCURRENCY // self._processes), STATS_TIMEOUT),
+        )
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def fetch_all(
+        self, host: "DockerHost", containers: list[ContainerInfo]
+    ) -> dict[str, dict | None]:
+        assert self._executor is not None, "The process engine is not running"
+
+        running = [
+            container for container in containers if container.status == "running"
+        ]
+        stats: dict[str, dict | None] = {
+            container.id: {}
+            for container in containers
+            if container.status != "running"
+        }
+        chunks = [running[index :: self._processes] for index in range(self._processes)]
+        futures = [
+            self._executor.submit(
+                fetch_stats_chunk,
+                host.url,
+                host.client.api.api_version,
+                [(container.id, container.needs_inspect()) for container in chunk],
+            )
+            for chunk in chunks
+            if chunk
+        ]
+
+        wait(futures, timeout=COLLECT_TIMEOUT)
+
+        for chunk, future in zip(filter(None, chunks), futures):
+            if not future.done():
+                future.cancel()
+
+                for container in chunk:
+                    record_error(host, container, "timeout", None)
+
+                continue
+
+            if (error := future.exception()) is not None:
+                for container in chunk:
+                    record_error(host, container, error_reason(error), error)
+
+                continue
+
+            for container, (_, sample, started_at, reason) in zip(
+                chunk, future.result()
+            ):
+                if reason is not None:
+                    record_error(host, container, reason, None)
+                    continue
+
+                if started_at is not None:
+                    container.update({"State": {"StartedAt": started_at}})
+
+                stats[container.id] = expand_stats(sample)
+
+        return stats
+
+
+process_engine = ProcessEngine(PROCESS_COUNT)
+
+
+CONTAINER_METRICS: dict[str, tuple[type[Metric], str]] = {
+    "docker_container_memory_usage_bytes": (
+        GaugeMetricFamily,
+        "Container memory usage (without caches)",
+    ),
+    "docker_container_memory_working_set_bytes": (
+        GaugeMetricFamily,
+        "Container memory usage without the inactive page cache, which is reclaimed first",
+    ),
+    "docker_container_memory_rss_bytes": (
+        GaugeMetricFamily,
+        "Container anonymous memory, like heaps and stacks",
+    ),
+    "docker_container_memory_cache_bytes": (
+        GaugeMetricFamily,
+        "Container page cache memory",
+    ),
+    "docker_container_memory_limit_bytes": (
+        GaugeMetricFamily,
+        "Container memory limit",
+    ),
+    "docker_container_memory_oom_events_total": (
+        CounterMetricFamily,
+        "Number of times the container hit its memory limit and invoked the OOM killer",
+    ),
+    "docker_container_cpu_usage_percent": (
+        GaugeMetricFamily,
+        "Container CPU usage percent (not divided by number of CPU cores)",
+    ),
+    "docker_container_cpu_usage_seconds_total": (
+        CounterMetricFamily,
+        "Total CPU time consumed by the container",
+    ),
+    "docker_container_uptime_seconds": (GaugeMetricFamily, "Container uptime"),
+    "docker_container_rootfs_size_bytes": (
+        GaugeMetricFamily,
+        "Container rootfs size in bytes",
+    ),
+    "docker_container_disk_size_bytes": (
+        GaugeMetricFamily,
+        "Container size on disk in bytes",
+    ),
+    "docker_container_mount_count": (GaugeMetricFamily, "Number of container mounts"),
+    "docker_container_network_receive_bytes_total": (
+        CounterMetricFamily,
+        "Bytes received by the container on all its network interfaces",
+    ),
+    "docker_container_network_receive_packets_total": (
+        CounterMetricFamily,
+        "Packets received by the container on all its network interfaces",
+    ),
+    "docker_container_network_receive_errors_total": (
+        CounterMetricFamily,
+        "Receive errors of the container on all its network interfaces",
+    ),
+    "docker_container_network_receive_dropped_total": (
+        CounterMetricFamily,
+        "Received packets dropped on all network interfaces of the container",
+    ),
+    "docker_container_network_transmit_bytes_total": (
+        CounterMetricFamily,
+        "Bytes transmitted by the container on all its network interfaces",
+    ),
+    "docker_container_network_transmit_packets_total": (
+        CounterMetricFamily,
+        "Packets transmitted by the container on all its network interfaces",
+    ),
+    "docker_container_network_transmit_errors_total": (
+        CounterMetricFamily,
+        "Transmit errors of the container on all its network interfaces",
+    ),
+    "docker_container_network_transmit_dropped_total": (
+        CounterMetricFamily,
+        "Transmitted packets dropped on all network interfaces of the container",
+    ),
+    "docker_container_blkio_read_bytes_total": (
+        CounterMetricFamily,
+        "Bytes read by the container from block devices",
+    ),
+    "docker_container_blkio_write_bytes_total": (
+        CounterMetricFamily,
+        "Bytes written by the container to block devices",
+    ),
+}
+
+# network metrics by the interface counter of the stats payload they sum up
+NETWORK_METRICS = {
+    f"docker_container_network_{direction}_{counter}_total": f"{prefix}_{counter}"
+    for direction, prefix in (("receive", "rx"), ("transmit", "tx"))
+    for counter in ("bytes", "packets", "errors", "dropped")
+}
+
+# HELP and TYPE lines of the container metrics in the text format
+CONTAINER_METRIC_HEADERS = {
+    name: "# HELP {0} {1}\n# TYPE {0} {2}\n".format(
+        name,
+        documentation.replace("\\", r"\\").replace("\n", r"\n"),
+        metric_type(name, documentation).type,
+    )
+    for name, (metric_type, documentation) in CONTAINER_METRICS.items()
+}
+
+Sample = tuple[tuple[str, ...], float]
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+class Snapshot:
+    """
+    Container metrics of a Docker host in a struct-of-arrays layout: a row of label values
+    per container and a column of floats per metric, with NaN where a container has no sample
+
+    The columns are kept across collections and overwritten in place while the containers
+    stay the same.
+    """
+
+    def __init__(self):
+        self.label_names = list[str]()
+        self.container_ids = list[str]()
+        self.labels = list[tuple[str, ...]]()
+        self.columns = {name: array("d") for name in CONTAINER_METRICS}
+        self.volumes = list[Sample]()
+        self.collected_at: datetime | None = None
+        self.lock = threading.Lock()
+        # escaped label blocks of the rows, rendered for the label names in `blocks_for`
+        self.blocks = dict[tuple[str, ...], str]()
+        self.blocks_for: tuple[tuple[str, ...], tuple[str, ...]] = ((), ())
+
+    def reset(self, container_ids: list[str]):
+        """
+        Clear all values, resizing the columns when the containers have changed
+        """
+
+        empty = array("d", [math.nan]) * len(container_ids)
+
+        if container_ids != self.container_ids:
+            self.container_ids = [
+                sys.intern(container_id) for container_id in container_ids
+            ]
+            self.columns = {name: array("d", empty) for name in CONTAINER_METRICS}
+        else:
+            for column in self.columns.values():
+                column[:] = empty
+
+    def age(self) -> float:
+        if self.collected_at is None:
+            return float("nan")
+
+        return (datetime.now(timezone.utc) - self.collected_at).total_seconds()
+
+
+snapshot_age = prometheus_client.Gauge(
+    "docker_discovery_snapshot_age_seconds",
+    "Age of the container metrics served by /metrics",
+    ["docker_host"],
+    registry=internal_registry,
+)
+
+
+class LabelSets:
+    """
+    Metric label values of the containers of a Docker host, resolved once per container and
+    reused until the container is gone or renamed, as the labels of a container never change
+    """
+
+    BASE_LABEL_NAMES = (
+        "job",
+        "container_name",
+        "image",
+        "image_id",
+        "container_id",
+        "docker_host",
+    )
+
+    def __init__(self, host_name: str):
+        self._host_name = host_name
+        # container name, target labels and label values by container ID, the label values are
+        # resolved for `label_names` on first use
+        self._entries = dict[str, tuple[str, dict[str, str], tuple[str, ...] | None]]()
+        self.label_names = list(self.BASE_LABEL_NAMES)
+
+    def resolve(self, containers: list[ContainerInfo]) -> list[tuple[str, ...]]:
+        """
+        Get the label values of the containers, in the order of `label_names`
+        """
+
+        entries = dict[str, tuple[str, dict[str, str], tuple[str, ...] | None]]()
+
+        for container in containers:
+            entry = self._entries.get(container.id)
+
+            if entry is None or entry[0] != container.name:
+                entry = (container.name, target_labels(container), None)
+
+            entries[container.id] = entry
+
+        # the label names are the union of the target labels, which only changes with the containers
+        if entries.keys() != self._entries.keys() or any(
+            entry is not self._entries.get(container_id)
+            for container_id, entry in entries.items()
+        ):
+            label_names = list(self.BASE_LABEL_NAMES)
+
+            for _, labels, _ in entries.values():
+                for label in labels.keys():
+                    if label not in label_names:
+                        label_names.append(label)
+
+            if label_names != self.label_names:
+                self.label_names = label_names
+                entries = {
+                    container_id: (name, labels, None)
+                    for container_id, (name, labels, _) in entries.items()
+                }
+
+        self._entries = entries
+        result = list[tuple[str, ...]]()
+
+        for container in containers:
+            name, labels, values = entries[container.id]
+
+            if values is None:
+                values = self._values(container, labels)
+                entries[container.id] = (name, labels, values)
+
+            result.append(values)
+
+        return result
+
+    def _values(
+        self, container: ContainerInfo, labels: dict[str, str]
+    ) -> tuple[str, ...]:
+        values = list[str]()
+
+        for label in self.label_names:
+            if label == "job":
+                values.append(container.labels[JOB_LABEL])
+            elif label == "container_name":
+                values.append(container.name or "")
+            elif label == "image":
+                values.append(container.image)
+            elif label == "image_id":
+                values.append(container.image_id)
+            elif label == "container_id":
+                values.append(container.id)
+            elif label == "docker_host":
+                values.append(self._host_name)
+            else:
+                values.append(labels.get(label, ""))
+
+        # label values repeat a lot across containers, e.g. jobs and images
+        return tuple(map(sys.intern, values))
+
+
+def build_snapshot(
+    host: "DockerHost",
+    containers: list[ContainerInfo],
+    stats: dict[str, dict | None],
+    now: datetime,
+) -> Snapshot:
+    """
+    Update the metrics table of a Docker host from already fetched data
+    """
+
+    labels = host.label_sets.resolve(containers)
+    snapshot = host.snapshot
+
+    with snapshot.lock:
+        snapshot.reset([container.id for container in containers])
+        snapshot.label_names = host.label_sets.label_names
+        snapshot.labels = labels
+        snapshot.collected_at = now
+        columns = snapshot.columns
+
+        for row, container in enumerate(containers):
+            if (sample := stats.get(container.id)) is not None:
+                memory_stats = sample.get("memory_stats", {})
+                memory_usage = memory_stats.get("usage", 0)
+                memory_stat = memory_stats.get("stats", {})
+
+                # the keys of the cgroup memory.stat file differ between cgroup v1 and v2
+                if "cache" in memory_stat:
+                    rss = memory_stat.get("rss")
+                    cache = memory_stat["cache"]
+                    inactive_file = memory_stat.get(
+                        "total_inactive_file", memory_stat.get("inactive_file", 0)
+                    )
+                else:
+                    rss = memory_stat.get("anon")
+                    cache = memory_stat.get("file")
+                    inactive_file = memory_stat.get("inactive_file", 0)
+
+                columns["docker_container_memory_usage_bytes"][row] = (
+                    memory_usage - cache if cache is not None else memory_usage
+                )
+                columns["docker_container_memory_working_set_bytes"][row] = (
+                    memory_usage - inactive_file
+                    if inactive_file < memory_usage
+                    else memory_usage
+                )
+
+                if rss is not None:
+                    columns["docker_container_memory_rss_bytes"][row] = rss
+
+                if cache is not None:
+                    columns["docker_container_memory_cache_bytes"][row] = cache
+
+                if (limit := memory_stats.get("limit")) is not None:
+                    columns["docker_container_memory_limit_bytes"][row] = limit
+
+                # on cgroup v2 the daemon reports the OOM events of memory.events as
+                # failcnt, on cgroup v1 failcnt counts the hits of the limit instead
+                if "cache" not in memory_stat and (
+                    (oom_events := memory_stats.get("failcnt")) is not None
+                ):
+                    columns["docker_container_memory_oom_events_total"][
+                        row
+                    ] = oom_events
+
+                cpu_stats = sample.get("cpu_stats", {})
+                precpu_stats = sample.get("precpu_stats", {})
+                cpu_delta = cpu_stats.get("cpu_usage", {}).get("total_usage", 0)
+                cpu_delta -= precpu_stats.get("cpu_usage", {}).get("total_usage", 0)
+                system_cpu_delta = cpu_stats.get("system_cpu_usage", 0)
+                system_cpu_delta -= precpu_stats.get("system_cpu_usage", 0)
+
+                # without previous counters, like on the first one-shot collection of a
+                # container, there is no interval to compute the usage over
+                if (
+                    precpu_stats.get("system_cpu_usage")
+                    and system_cpu_delta > 0
+                    and cpu_delta >= 0
+                ):
+                    columns["docker_container_cpu_usage_percent"][row] = (
+                        (cpu_delta / system_cpu_delta)
+                        * cpu_stats["online_cpus"]
+                        * 100.0
+                    )
+
+                if (
+                    total_usage := cpu_stats.get("cpu_usage", {}).get("total_usage")
+                ) is not None:
+                    columns["docker_container_cpu_usage_seconds_total"][row] = (
+                        total_usage / 1e9
+                    )
+
+                # containers without a network namespace of their own have no networks
+                if networks := sample.get("networks"):
+                    for name, key in NETWORK_METRICS.items():
+                        columns[name][row] = sum(
+                            interface.get(key, 0) for interface in networks.values()
+                        )
+
+                # `null` without the io controller of cgroup v2
+                if (
+                    io_service_bytes := sample.get("blkio_stats", {}).get(
+                        "io_service_bytes_recursive"
+                    )
+                ) is not None:
+                    read = written = 0
+
+                    # cgroup v1 reports the operations capitalized, along with their total
+                    for entry in io_service_bytes:
+                        if (op := entry.get("op", "").lower()) == "read":
+                            read += entry.get("value", 0)
+                        elif op == "write":
+                            written += entry.get("value", 0)
+
+                    columns["docker_container_blkio_read_bytes_total"][row] = read
+                    columns["docker_container_blkio_write_bytes_total"][row] = written
+
+            if container.status != "running":
+                columns["docker_container_uptime_seconds"][row] = 0
+            elif container.started_at is not None:
+                columns["docker_container_uptime_seconds"][row] = (
+                    now - container.started_at
+                ).total_seconds()
+
+            if (container_df := host.disk_usage.container(container.id)) is not None:
+                columns["docker_container_rootfs_size_bytes"][row] = container_df.get(
+                    "SizeRootFs", 0
+                )
+
+                if "SizeRw" in container_df:
+                    columns["docker_container_disk_size_bytes"][row] = container_df[
+                        "SizeRw"
+                    ]
+
+                columns["docker_container_mount_count"][row] = len(
+                    container_df.get("Mounts") or []
+                )
+
+        # volumes do not belong to a single container, so only the first shard exports them
+        snapshot.volumes = [
+            ((volume["Name"], host.name), volume["UsageData"]["Size"])
+            for volume in host.disk_usage.volumes()
+            if SHARD_INDEX == 0
+        ]
+
+    return snapshot
+
+
+class SnapshotCollector(Collector):
+    """
+    Exposes the latest snapshot of every Docker host without creating metric objects
+    for every series on every scrape
+    """
+
+    def __init__(self):
+        self.snapshots = dict[str, Snapshot]()
+
+    def collect(self) -> Iterable[Metric]:
+        snapshots = self._snapshots()
+
+        if not snapshots:
+            return []
+
+        label_names = self._label_names(snapshots)
+        families = list[Metric]()
+
+        with ExitStack() as stack:
+            for snapshot in snapshots:
+                stack.enter_context(snapshot.lock)
+
+            for name, (metric_type, documentation) in CONTAINER_METRICS.items():
+                family = metric_type(name, documentation, labels=label_names)
+
+                for snapshot in snapshots:
+                    align = self._aligner(snapshot.label_names, label_names)
+
+                    for label_values, value in zip(
+                        snapshot.labels, snapshot.columns[name]
+                    ):
+                        # NaN marks the containers without the sample
+                        if value == value:
+                            family.add_metric(align(label_values), value)
+
+                families.append(family)
+
+            family = GaugeMetricFamily(
+                "docker_volume_size_bytes",
+                "Size of a volume in bytes.",
+                labels=["volume_id", "docker_host"],
+            )
+
+            for snapshot in snapshots:
+                for label_values, value in snapshot.volumes:
+                    family.add_metric(label_values, value)
+
+            families.append(family)
+
+        return families
+
+    def expose(self) -> bytes:
+        """
+        Render the snapshots in the text format, byte for byte like `generate_latest` renders
+        the families of `collect`
+
+        The escaped label block of every container is cached across scrapes, so only the values
+        are formatted.
+        """
+
+        snapshots = self._snapshots()
+
+        if not snapshots:
+            return b""
+
+        label_names = self._label_names(snapshots)
+        output = list[str]()
+
+        with ExitStack() as stack:
+            for snapshot in snapshots:
+                stack.enter_context(snapshot.lock)
+
+            blocks = [self._blocks(snapshot, label_names) for snapshot in snapshots]
+
+            for name, header in CONTAINER_METRIC_HEADERS.items():
+                output.append(header)
+
+                for snapshot, snapshot_blocks in zip(snapshots, blocks):
+                    for block, value in zip(snapshot_blocks, snapshot.columns[name]):
+                        if value == value:
+                            output.append(
+                                f"{name}{{{block}}} {floatToGoString(value)}\n"
+                            )
+
+            output.append(
+                "# HELP docker_volume_size_bytes Size of a volume in bytes.\n"
+                "# TYPE docker_volume_size_bytes gauge\n"
+            )
+
+            for snapshot in snapshots:
+                for (volume_id, docker_host), value in snapshot.volumes:
+                    output.append(
+                        f'docker_volume_size_bytes{{docker_host="{escape_label_value(docker_host)}",'
+                        f'volume_id="{escape_label_value(volume_id)}"}} {floatToGoString(value)}\n'
+                    )
+
+        return "".join(output).encode()
+
+    def _snapshots(self) -> list[Snapshot]:
+        return [
+            self.snapshots[host.name] for host in hosts if host.name in self.snapshots
+        ]
+
+    @staticmethod
+    def _label_names(snapshots: list[Snapshot]) -> list[str]:
+        # the hosts can have different target labels, so their samples are aligned to the union of them
+        label_names = list[str]()
+
+        for snapshot in snapshots:
+            label_names.extend(
+                label for label in snapshot.label_names if label not in label_names
+            )
+
+        return label_names
+
+    @classmethod
+    def _blocks(cls, snapshot: Snapshot, label_names: list[str]) -> list[str]:
+        """
+        Get the escaped label blocks of the rows of a snapshot, which has to be locked
+        """
+
+        blocks_for = (tuple(snapshot.label_names), tuple(label_names))
+
+        if snapshot.blocks_for != blocks_for:
+            snapshot.blocks = {}
+            snapshot.blocks_for = blocks_for
+
+        align = cls._aligner(snapshot.label_names, label_names)
+        # the text format has the labels sorted by name
+        order = sorted(range(len(label_names)), key=label_names.__getitem__)
+        cached = snapshot.blocks
+        blocks = dict[tuple[str, ...], str]()
+
+        for label_values in snapshot.labels:
+            if (block := cached.get(label_values)) is None:
+                aligned = align(label_values)
+                block = ",".join(
+                    f'{label_names[index]}="{escape_label_value(aligned[index])}"'
+                    for index in order
+                )
+
+            blocks[label_values] = block
+
+        # only the blocks of current rows are kept
+        snapshot.blocks = blocks
+
+        return list(blocks.values())
+
+    @staticmethod
+    def _aligner(
+        label_names: list[str], target: list[str]
+    ) -> Callable[[tuple[str, ...]], tuple[str, ...]]:
+        if label_names == target:
+            return lambda label_values: label_values
+
+        positions = [
+            label_names.index(label) if label in label_names else None
+            for label in target
+        ]
+
+        return lambda label_values: tuple(
+            "" if position is None else label_values[position] for position in positions
+        )
+
+
+metrics_registry = prometheus_client.CollectorRegistry()
+snapshot_collector = SnapshotCollector()
+metrics_registry.register(snapshot_collector)
+
+
+def collect(host: "DockerHost") -> Snapshot:
+    """
+    Query the Docker daemon and build a snapshot of the current container metrics
+    """
+
+    if STATS_ENGINE == "async":
+        return host.async_engine.submit(collect_async(host)).result()
+
+    with phase_duration.labels("collect").time():
+        now = datetime.now(timezone.utc)
+        containers = host.inventory.containers()
+        collected_containers.labels(host.name).set(len(containers))
+        stats = fetch_all(host, containers)
+        host.cpu_tracker.track(stats, {container.id for container in containers})
+
+        return build_snapshot(host, containers, stats, now)
+
+
+async def collect_async(host: "DockerHost") -> Snapshot:
+    with phase_duration.labels("collect").time():
+        now = datetime.now(timezone.utc)
+        containers = host.inventory.containers()
+        collected_containers.labels(host.name).set(len(containers))
+        stats = await host.async_engine.fetch_all(containers)
+        host.cpu_tracker.track(stats, {container.id for container in containers})
+
+        return build_snapshot(host, containers, stats, now)
+
+
+class BackgroundCollector(PeriodicTask):
+    """
+    Periodically refreshes the metrics snapshot so that scrapes never wait for the Docker daemon
+    """
+
+    def __init__(self, host: "DockerHost", interval: float):
+        super().__init__(interval)
+        self.name = f"collector-{host.name}"
+        self._host = host
+        self._snapshot: Snapshot | None = None
+        self._ready = threading.Event()
+
+    async def latest(self, timeout: float | None = None) -> Snapshot | None:
+        if not self._ready.is_set():
+            await asyncio.to_thread(self._ready.wait, timeout)
+
+        return self._snapshot
+
+    def run_once(self):
+        self._snapshot = collect(self._host)
+        snapshot_collector.snapshots[self._host.name] = self._snapshot
+        self._ready.set()
+
+
+class OnDemandCollector:
+    """
+    Collects when scraped; scrapes arriving while a collection is in progress wait for it
+    and share its result, and results younger than `max_age` are served outright
+    """
+
+    def __init__(self, host: "DockerHost", max_age: float):
+        self.max_age = max_age
+        self._host = host
+        self._snapshot: Snapshot | None = None
+        self._collected_at = 0.0
+        self._in_flight: asyncio.Task[Snapshot] | None = None
+
+    async def latest(self) -> Snapshot:
+        if (
+            self._snapshot is not None
+            and time.monotonic() - self._collected_at < self.max_age
+        ):
+            return self._snapshot
+
+        if self._in_flight is None:
+            self._in_flight = asyncio.create_task(self._collect())
+
+        # a disconnected scraper must not cancel the collection shared with the others
+        return await asyncio.shield(self._in_flight)
+
+    def revalidate(self) -> asyncio.Task[Snapshot] | None:
+        """
+        Start a collection without waiting for it if the latest result is older than `max_age`,
+        return the collection in progress
+        """
+
+        if self._in_flight is None and (
+            self._snapshot is None
+            or time.monotonic() - self._collected_at >= self.max_age
+        ):
+            self._in_flight = asyncio.create_task(self._collect())
+            self._in_flight.add_done_callback(self._log_failure)
+
+        return self._in_flight
+
+    def _log_failure(self, task: asyncio.Task[Snapshot]):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                "Collecting %s failed", self._host.name, exc_info=task.exception()
+            )
+
+    async def _collect(self) -> Snapshot:
+        try:
+            if STATS_ENGINE == "async":
+                future = self._host.async_engine.submit(collect_async(self._host))
+                snapshot = await asyncio.wrap_future(future)
+            else:
+                snapshot = await run_in_threadpool(collect, self._host)
+
+            self._snapshot = snapshot_collector.snapshots[self._host.name] = snapshot
+            self._collected_at = time.monotonic()
+
+            return snapshot
+        finally:
+            self._in_flight = None
+
+
+class DockerHost:
+    """
+    A single Docker daemon with its own clients, inventory, caches and collectors,
+    so that a slow or unreachable daemon never holds back the others
+    """
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.url = url
+        self.local = urlparse(url).scheme in ("unix", "http+unix", "npipe")
+        # address of the daemon machine, `None` for local daemons
+        self.address = None if self.local else urlparse(url).hostname
+
+        if STATS_ENGINE == "async" and urlparse(url).scheme not in (
+            "unix",
+            "http+unix",
+            "tcp",
+            "http",
+        ):
+            raise ValueError(f"The async stats engine does not support {url}")
+
+        self._client: DockerClient | None = None
+        self._stats_client: DockerClient | None = None
+        self._connect_lock = threading.Lock()
+
+        self.inventory = Inventory(self.connect, name=name)
+        self.disk_usage = DiskUsage(self.connect, DISK_USAGE_INTERVAL)
+        self.stats_streams = StatsStreams(self.connect)
+        self.cpu_tracker = CpuTracker()
+        self.label_sets = LabelSets(name)
+        self.snapshot = Snapshot()
+        self.async_engine = AsyncEngine(self, ASYNC_CONCURRENCY)
+        self.collector = BackgroundCollector(self, COLLECT_INTERVAL)
+        self.on_demand_collector = OnDemandCollector(self, METRICS_MAX_AGE)
+
+        disk_usage_age.labels(name).set_function(self.disk_usage.age)
+        snapshot_age.labels(name).set_function(self.snapshot.age)
+
+    @property
+    def client(self) -> DockerClient:
+        return self.connect()
+
+    @property
+    def stats_client(self) -> DockerClient:
+        self.connect()
+        assert self._stats_client is not None
+
+        return self._stats_client
+
+    def connect(self) -> DockerClient:
+        """
+        Get the main client, creating the clients on first use
+
+        Creating a client asks the daemon for its API version, so an unreachable daemon only fails
+        the requests made to it, and the next request tries again. Neither the version request
+        nor the wait for another caller's attempt takes longer than `CONNECT_TIMEOUT`.
+        """
+
+        if (client := self._client) is not None:
+            return client
+
+        if not self._connect_lock.acquire(timeout=CONNECT_TIMEOUT):
+            raise TimeoutError(f"Connecting to the Docker host {self.name} timed out")
+
+        try:
+            if self._client is None:
+                probe = docker_client(self.url, 1, timeout=CONNECT_TIMEOUT)
+
+                try:
+                    version = probe.api.api_version
+                finally:
+                    probe.close()
+
+                # the pools hold a connection for every concurrent request of a collection,
+                # containers are inspected with the main client while their stats are fetched
+                client = docker_client(self.url, COLLECT_CONCURRENCY, version=version)
+                # stats requests get a short timeout of their own so that a single hung container
+                # cannot stall them
+                self._stats_client = docker_client(
+                    self.url,
+                    COLLECT_CONCURRENCY,
+                    version=version,
+                    timeout=STATS_TIMEOUT,
+                )
+                self._client = client
+
+            return self._client
+        finally:
+            self._connect_lock.release()
+
+    def clients(self) -> dict[str, DockerClient]:
+        """
+        Clients created so far, by their role
+        """
+
+        if self._client is None or self._stats_client is None:
+            return {}
+
+        return {"api": self._client, "stats": self._stats_client}
+
+    def start(self):
+        """
+        Start the background work of the host without waiting for the daemon, the events watcher
+        lists the containers as soon as it is reachable
+        """
+
+        self.inventory.start()
+        self.disk_usage.start()
+
+        if STATS_ENGINE == "async":
+            self.async_engine.start()
+
+        if METRICS_MODE == "background":
+            self.collector.start()
+
+    def stop(self):
+        if METRICS_MODE == "background":
+            self.collector.stop()
+
+        self.stats_streams.close()
+        self.async_engine.stop()
+        self.disk_usage.stop()
+        self.inventory.stop()
+
+
+def parse_docker_hosts(value: str) -> list[tuple[str, str]]:
+    """
+    Parse a comma separated list of Docker hosts, each either `url` or `name=url`
+    """
+
+    result = list[tuple[str, str]]()
+
+    for entry in filter(None, map(str.strip, value.split(","))):
+        name, separator, url = entry.partition("=")
+
+        if not separator or "://" in name:
+            name, url = "", entry
+
+        if not name:
+            name = urlparse(url).hostname or "localhost"
+
+        if name in (existing for existing, _ in result):
+            raise ValueError(f"Duplicate Docker host name {name}, name them explicitly")
+
+        result.append((name, url))
+
+    return result
+
+
+hosts = [DockerHost(name, url) for name, url in parse_docker_hosts(DOCKER_HOSTS)]
+
+
+class ConnectionPoolCollector(Collector):
+    """
+    Exposes how many connections the Docker clients opened for how many requests,
+    which shows how well the connections are kept alive and reused
+    """
+
+    def collect(self) -> Iterable[Metric]:
+        connections = CounterMetricFamily(
+            "docker_discovery_docker_connections",
+            "Connections opened to the Docker daemons",
+            labels=["docker_host", "client"],
+        )
+        sent = CounterMetricFamily(
+            "docker_discovery_docker_requests",
+            "Requests sent to the Docker daemons",
+            labels=["docker_host", "client"],
+        )
+
+        for host in hosts:
+            for name, client in host.clients().items():
+                pools = connection_pools(client)
+                connections.add_metric(
+                    [host.name, name], sum(pool.num_connections for pool in pools)
+                )
+                sent.add_metric(
+                    [host.name, name], sum(pool.num_requests for pool in pools)
+                )
+
+        yield connections
+        yield sent
+
+
+internal_registry.register(ConnectionPoolCollector())
+
+
+@app.get("/metrics", response_class=PrometheusMetricsResponse)
+async def get_metrics():
+    """
+    Retrieve Prometheus metrics
+    """
+
+    if METRICS_MODE == "background":
+        if not snapshot_collector.snapshots:
+            # wait for the first snapshot of any host rather than for all of them
+            tasks = [
+                asyncio.ensure_future(host.collector.latest(timeout=COLLECT_INTERVAL))
+                for host in hosts
+            ]
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in tasks:
+                task.cancel()
+    elif METRICS_MODE == "stale-while-revalidate":
+        # the latest snapshots are served right away, stale ones are refreshed for later scrapes
+        collections = [host.on_demand_collector.revalidate() for host in hosts]
+
+        if not snapshot_collector.snapshots:
+            await asyncio.wait(
+                [collection for collection in collections if collection is not None],
+                timeout=COLLECT_TIMEOUT,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+    else:
+        tasks = [
+            asyncio.ensure_future(host.on_demand_collector.latest()) for host in hosts
+        ]
+        # hosts that do not finish in time are served from their previous snapshot
+        done, pending = await asyncio.wait(tasks, timeout=COLLECT_TIMEOUT)
+
+        for task in pending:
+            task.cancel()
+
+        for host, task in zip(hosts, tasks):
+            if task in done and task.exception() is not None:
+                logger.warning(
+                    "Collecting %s failed", host.name, exc_info=task.exception()
+                )
+
+    if not snapshot_collector.snapshots:
+        return PrometheusMetricsResponse(status_code=503)
+
+    with phase_duration.labels("serialize").time():
+        body = snapshot_collector.expose()
+
+    response_size.observe(len(body))
+
+    return PrometheusMetricsResponse(
+        body + prometheus_client.generate_latest(internal_registry)
+    )
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# the service reads its settings at import time, the hosts are never contacted by the tests
+os.environ["DISCOVERY_DOCKER_HOSTS"] = (
+    "local=unix:///nonexistent/docker.sock, remote=tcp://docker.invalid:2375"
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture
+def docker_socket(tmp_path) -> str:
+    return str(tmp_path / "docker.sock")
+
+
+@pytest.fixture
+def fake_docker(docker_socket):
+    """
+    Simulated Docker daemon of the benchmark, serving three containers on `docker_socket`
+    """
+
+    daemon = benchmark.FakeDocker(3, 1, {})
+    daemon.start(docker_socket)
+
+    yield daemon
+
+    daemon.stop()
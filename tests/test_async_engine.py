@@ -0,0 +1,112 @@
+import asyncio
+
+import httpx
+import pytest
+
+import prometheus_docker_discovery as discovery
+from prometheus_docker_discovery import (
+    AsyncDockerClient,
+    AsyncEngine,
+    ContainerInfo,
+    DockerHost,
+    error_reason,
+    internal_registry,
+)
+
+
+@pytest.fixture
+def host(fake_docker, docker_socket) -> DockerHost:
+    host = DockerHost("fake", f"unix://{docker_socket}")
+    host.inventory.resync()
+
+    return host
+
+
+@pytest.fixture
+def engine(host):
+    engine = AsyncEngine(host, 2)
+    engine.start()
+
+    yield engine
+
+    engine.stop()
+
+
+def collect_errors(host: DockerHost, container: ContainerInfo, reason: str) -> float:
+    return (
+        internal_registry.get_sample_value(
+            "docker_discovery_collect_errors_total",
+            {
+                "docker_host": host.name,
+                "container_name": container.name,
+                "reason": reason,
+            },
+        )
+        or 0
+    )
+
+
+def test_client(fake_docker, docker_socket):
+    container_id = next(iter(fake_docker.containers))
+
+    async def requests():
+        client = AsyncDockerClient(f"unix://{docker_socket}", "1.45", 4)
+
+        try:
+            inspect = await client.inspect_container(container_id)
+            stats = await client.stats(container_id, one_shot=True)
+
+            with pytest.raises(httpx.HTTPStatusError) as error:
+                await client.stats("f" * 64)
+        finally:
+            await client.aclose()
+
+        return inspect, stats, error.value
+
+    inspect, stats, error = asyncio.run(requests())
+
+    assert inspect["Id"] == container_id
+    assert stats["memory_stats"]["usage"] == 100_000_000
+    assert error_reason(error) == "not_found"
+    assert fake_docker.counts == {"inspect": 1, "stats": 2}
+
+
+def test_unsupported_host():
+    with pytest.raises(ValueError):
+        AsyncDockerClient("ssh://docker.invalid", "1.45", 4)
+
+
+def test_fetch_all(fake_docker, host, engine):
+    containers = host.inventory.containers()
+    stopped = ContainerInfo("e" * 64, "stopped", {}, "exited", "alpine", "", {})
+    removed = ContainerInfo("f" * 64, "removed", {}, "running", "alpine", "", {})
+    connections = fake_docker.connections
+
+    stats = engine.submit(engine.fetch_all([*containers, stopped, removed])).result()
+
+    assert stats.keys() == {container.id for container in [*containers, stopped]}
+    assert all(stats[container.id]["cpu_stats"] for container in containers)
+    assert stats[stopped.id] == {}
+    assert all(container.started_at is not None for container in containers)
+    assert collect_errors(host, removed, "not_found") == 1
+
+    engine.submit(engine.fetch_all(containers)).result()
+
+    # the start times are inspected once, and no more connections than the concurrency
+    # are opened across collections
+    assert fake_docker.counts["inspect"] == len(containers) + 1
+    assert fake_docker.counts["stats"] == 2 * len(containers)
+    assert fake_docker.connections - connections <= 2
+
+
+def test_fetch_all_timeout(monkeypatch, fake_docker, host, engine):
+    containers = host.inventory.containers()
+    fake_docker.latency["stats"] = 1.0
+    monkeypatch.setattr(discovery, "COLLECT_TIMEOUT", 0.2)
+
+    stats = engine.submit(engine.fetch_all(containers)).result()
+
+    assert stats == {}
+    assert all(
+        collect_errors(host, container, "timeout") == 1 for container in containers
+    )
@@ -0,0 +1,175 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import prometheus_docker_discovery as discovery
+from prometheus_docker_discovery import CgroupStats, ContainerInfo
+
+CONTAINER_ID = "c" * 64
+
+CGROUP_FILES = {
+    "cpu.stat": "usage_usec 5000000\nuser_usec 3000000\nsystem_usec 2000000\n",
+    "memory.stat": "anon 6000\nfile 3000\ninactive_file 1000\n",
+    "memory.events": "low 0\nhigh 0\nmax 4\noom 2\noom_kill 1\n",
+    "memory.current": "10000\n",
+    "memory.max": "20000\n",
+    "io.stat": "8:0 rbytes=4096 wbytes=8192 rios=1 wios=2 dbytes=0 dios=0\n",
+    "cpuset.cpus.effective": "0-3\n",
+}
+
+
+@pytest.fixture
+def cgroup_root(tmp_path) -> str:
+    root = tmp_path / "cgroup"
+    root.mkdir()
+    (root / "cgroup.controllers").write_text("cpuset cpu io memory pids\n")
+
+    return str(root)
+
+
+@pytest.fixture
+def proc_root(tmp_path) -> str:
+    root = tmp_path / "proc"
+    root.mkdir()
+    (root / "stat").write_text(
+        "cpu  100 10 50 800 20 5 15 0 0 0\ncpu0 50 5 25 400 10 2 8 0 0 0\n"
+    )
+
+    return str(root)
+
+
+@pytest.fixture
+def cgroup_stats(cgroup_root, proc_root) -> CgroupStats:
+    return CgroupStats(cgroup_root, proc_root)
+
+
+def container_cgroup(
+    root: str,
+    files: dict[str, str] = CGROUP_FILES,
+    pattern: str = CgroupStats.CONTAINER_PATHS[0],
+    container_id: str = CONTAINER_ID,
+) -> str:
+    path = os.path.join(root, pattern.format(container_id))
+    os.makedirs(path)
+
+    for name, content in files.items():
+        with open(os.path.join(path, name), "w") as file:
+            file.write(content)
+
+    return path
+
+
+def test_available(cgroup_root, proc_root, tmp_path):
+    assert CgroupStats(cgroup_root, proc_root).available()
+    assert not CgroupStats(str(tmp_path / "missing"), proc_root).available()
+
+
+@pytest.mark.parametrize("pattern", CgroupStats.CONTAINER_PATHS)
+def test_path_layouts(cgroup_stats, cgroup_root, pattern):
+    container_cgroup(cgroup_root, pattern=pattern)
+
+    assert cgroup_stats.read(CONTAINER_ID) == {
+        "cpu_stats": {
+            "cpu_usage": {"total_usage": 5_000_000_000},
+            "system_cpu_usage": 1000 * 1_000_000_000 // os.sysconf("SC_CLK_TCK"),
+            "online_cpus": 4,
+        },
+        "memory_stats": {
+            "usage": 10000,
+            "limit": 20000,
+            "stats": {"anon": 6000, "file": 3000, "inactive_file": 1000},
+            "failcnt": 2,
+        },
+        "blkio_stats": {
+            "io_service_bytes_recursive": [
+                {"major": 8, "minor": 0, "op": "read", "value": 4096},
+                {"major": 8, "minor": 0, "op": "write", "value": 8192},
+            ]
+        },
+    }
+
+
+def test_unlimited_memory(cgroup_stats, cgroup_root):
+    container_cgroup(cgroup_root, {**CGROUP_FILES, "memory.max": "max\n"})
+    memory_stats = cgroup_stats.read(CONTAINER_ID)["memory_stats"]
+
+    assert "limit" not in memory_stats
+    assert memory_stats["usage"] == 10000
+
+
+def test_empty_io_stat(cgroup_stats, cgroup_root):
+    container_cgroup(cgroup_root, {**CGROUP_FILES, "io.stat": ""})
+
+    assert cgroup_stats.read(CONTAINER_ID)["blkio_stats"] == {
+        "io_service_bytes_recursive": []
+    }
+
+
+@pytest.mark.parametrize(
+    "cpus, online_cpus",
+    [
+        ("0\n", 1),
+        ("0-3\n", 4),
+        ("0-3,6\n", 5),
+        ("0,2,4-5,8-11\n", 8),
+        ("\n", os.cpu_count()),
+    ],
+)
+def test_cpuset_ranges(cgroup_stats, cgroup_root, cpus, online_cpus):
+    container_cgroup(cgroup_root, {**CGROUP_FILES, "cpuset.cpus.effective": cpus})
+
+    assert cgroup_stats.read(CONTAINER_ID)["cpu_stats"]["online_cpus"] == online_cpus
+
+
+def test_without_cpuset(cgroup_stats, cgroup_root):
+    files = dict(CGROUP_FILES)
+    del files["cpuset.cpus.effective"]
+    container_cgroup(cgroup_root, files)
+
+    assert cgroup_stats.read(CONTAINER_ID)["cpu_stats"]["online_cpus"] == (
+        os.cpu_count()
+    )
+
+
+def test_missing_cgroup_directory(cgroup_stats):
+    assert cgroup_stats.read(CONTAINER_ID) is None
+
+
+def test_stopped_container(cgroup_stats, cgroup_root):
+    path = container_cgroup(cgroup_root)
+    assert cgroup_stats.read(CONTAINER_ID) is not None
+
+    # the kernel removes the cgroup files when the container stops
+    for name in CGROUP_FILES:
+        os.unlink(os.path.join(path, name))
+
+    assert cgroup_stats.read(CONTAINER_ID) is None
+
+
+def test_engine_falls_back_to_the_api(monkeypatch, cgroup_stats, cgroup_root):
+    container_cgroup(cgroup_root)
+    api_stats = {"memory_stats": {"usage": 1}}
+    requested = list[str]()
+
+    def stats(container_id: str, **kwargs) -> dict:
+        requested.append(container_id)
+        return api_stats
+
+    host = SimpleNamespace(
+        local=True,
+        client=SimpleNamespace(api=SimpleNamespace(api_version="1.45")),
+        stats_client=SimpleNamespace(api=SimpleNamespace(stats=stats)),
+    )
+    monkeypatch.setattr(discovery, "STATS_ENGINE", "cgroup")
+    monkeypatch.setattr(discovery, "cgroup_stats", cgroup_stats)
+
+    def container(container_id: str) -> ContainerInfo:
+        return ContainerInfo(container_id, "name", {}, "running", "image", "", {})
+
+    cgroup = discovery.container_stats(host, container(CONTAINER_ID))
+    fallback = discovery.container_stats(host, container("d" * 64))
+
+    assert cgroup["memory_stats"]["usage"] == 10000
+    assert fallback is api_stats
+    assert requested == ["d" * 64]
@@ -0,0 +1,82 @@
+import json
+import socket
+import time
+
+import pytest
+from docker.errors import DockerException
+
+import prometheus_docker_discovery as discovery
+from prometheus_docker_discovery import DockerHost, TargetsCache
+
+
+@pytest.fixture
+def hung_socket(tmp_path):
+    """
+    Unix socket of a daemon that accepts connections but never answers
+    """
+
+    path = str(tmp_path / "hung.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+
+    yield path
+
+    server.close()
+
+
+@pytest.fixture
+def connect_timeout(monkeypatch) -> float:
+    monkeypatch.setattr(discovery, "CONNECT_TIMEOUT", 0.2)
+
+    return 0.2
+
+
+def test_connect_times_out(hung_socket, connect_timeout):
+    host = DockerHost("hung", f"unix://{hung_socket}")
+    started = time.monotonic()
+
+    with pytest.raises(DockerException):
+        host.connect()
+
+    assert time.monotonic() - started < 5 * connect_timeout
+    assert host.clients() == {}
+
+
+def test_connect_does_not_queue(hung_socket, connect_timeout):
+    host = DockerHost("hung", f"unix://{hung_socket}")
+    started = time.monotonic()
+
+    # callers give up instead of queueing behind an attempt in progress
+    with host._connect_lock, pytest.raises(TimeoutError):
+        host.connect()
+
+    assert time.monotonic() - started < 5 * connect_timeout
+
+
+def test_connect(fake_docker, docker_socket):
+    host = DockerHost("fake", f"unix://{docker_socket}")
+
+    assert host.connect() is host.client
+    assert host.clients().keys() == {"api", "stats"}
+    assert host.stats_client.api.timeout == discovery.STATS_TIMEOUT
+    assert fake_docker.counts == {"version": 1}
+
+
+def test_targets_do_not_wait_for_a_hung_host(
+    monkeypatch, fake_docker, docker_socket, hung_socket, connect_timeout
+):
+    healthy = DockerHost("fake", f"unix://{docker_socket}")
+    hung = DockerHost("hung", f"unix://{hung_socket}")
+    monkeypatch.setattr(discovery, "hosts", [hung, healthy])
+    cache = TargetsCache()
+
+    healthy.inventory.resync()
+    started = time.monotonic()
+    body, etag = cache.get()
+
+    assert time.monotonic() - started < connect_timeout
+    assert {target["labels"]["docker_host"] for target in json.loads(body)} == {"fake"}
+    assert len(json.loads(body)) == len(fake_docker.containers)
+    assert hung.clients() == {}
+    assert cache.get() == (body, etag)
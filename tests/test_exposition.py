@@ -0,0 +1,146 @@
+import math
+from array import array
+from typing import Iterable
+
+import pytest
+from prometheus_client import CollectorRegistry, generate_latest
+
+import prometheus_docker_discovery as discovery
+from prometheus_docker_discovery import (
+    CONTAINER_METRICS,
+    LabelSets,
+    Snapshot,
+    SnapshotCollector,
+)
+
+
+def make_snapshot(
+    host: str,
+    target_labels: list[str],
+    containers: int,
+    volumes: Iterable[tuple[str, float]] = (),
+    gaps: bool = False,
+) -> Snapshot:
+    snapshot = Snapshot()
+    snapshot.label_names = [*LabelSets.BASE_LABEL_NAMES, *target_labels]
+    snapshot.labels = [
+        (
+            f"job-{index}",
+            f"container-{index}",
+            "alpine:latest",
+            "sha256:" + "a" * 64,
+            f"{host}-{index:062x}",
+            host,
+            *(f"{label}-{index}" for label in target_labels),
+        )
+        for index in range(containers)
+    ]
+    snapshot.reset([f"{host}-{index:062x}" for index in range(containers)])
+
+    for column_index, name in enumerate(CONTAINER_METRICS):
+        snapshot.columns[name] = array(
+            "d",
+            [
+                # every other container misses the samples of every third metric
+                (
+                    math.nan
+                    if gaps and index % 2 and column_index % 3 == 0
+                    else index * 1024.5 + column_index / 3
+                )
+                for index in range(containers)
+            ],
+        )
+
+    snapshot.volumes = [((volume, host), size) for volume, size in volumes]
+
+    return snapshot
+
+
+def assert_exposed_like_generate_latest(collector: SnapshotCollector):
+    registry = CollectorRegistry()
+    registry.register(collector)
+
+    assert collector.expose() == generate_latest(registry)
+    # a second scrape is served from the cached label blocks
+    assert collector.expose() == generate_latest(registry)
+
+
+@pytest.fixture
+def collector():
+    return SnapshotCollector()
+
+
+def test_no_snapshots(collector):
+    assert collector.expose() == b""
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_hosts_with_different_target_labels(collector):
+    collector.snapshots["local"] = make_snapshot(
+        "local", ["team", "tier"], 3, [("data", 4096)]
+    )
+    collector.snapshots["remote"] = make_snapshot(
+        "remote", ["zone", "team"], 2, [("logs", 1.5e10)]
+    )
+
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_target_labels_change_between_scrapes(collector):
+    collector.snapshots["local"] = make_snapshot("local", ["team"], 2)
+    collector.snapshots["remote"] = make_snapshot("remote", [], 2)
+    assert_exposed_like_generate_latest(collector)
+
+    collector.snapshots["remote"] = make_snapshot("remote", ["zone"], 3)
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_missing_samples(collector):
+    collector.snapshots["local"] = make_snapshot("local", ["team"], 5, gaps=True)
+
+    assert b"NaN" not in collector.expose()
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_label_value_escaping(collector):
+    snapshot = make_snapshot("local", ["description"], 1, [('back\\slash "volume"', 1)])
+    snapshot.labels = [
+        snapshot.labels[0][:-1] + ('container "0"\\\nof the test\\n',),
+    ]
+    collector.snapshots["local"] = snapshot
+
+    assert (
+        b'description="container \\"0\\"\\\\\\nof the test\\\\n"' in collector.expose()
+    )
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_counter_families(collector):
+    collector.snapshots["local"] = make_snapshot("local", [], 2)
+    exposed = collector.expose()
+
+    assert b"# TYPE docker_container_cpu_usage_seconds_total counter\n" in exposed
+    assert b"\ndocker_container_cpu_usage_seconds_total{" in exposed
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_empty_volume_list(collector):
+    collector.snapshots["local"] = make_snapshot("local", ["team"], 2, [])
+    collector.snapshots["remote"] = make_snapshot("remote", [], 0, [])
+
+    assert collector.expose().endswith(
+        b"# HELP docker_volume_size_bytes Size of a volume in bytes.\n"
+        b"# TYPE docker_volume_size_bytes gauge\n"
+    )
+    assert_exposed_like_generate_latest(collector)
+
+
+def test_snapshots_follow_the_order_of_the_hosts(collector):
+    assert [host.name for host in discovery.hosts] == ["local", "remote"]
+
+    collector.snapshots["remote"] = make_snapshot("remote", [], 1)
+    collector.snapshots["local"] = make_snapshot("local", [], 1)
+    exposed = collector.expose().decode()
+
+    assert exposed.index('docker_host="local"') < exposed.index('docker_host="remote"')
+    assert_exposed_like_generate_latest(collector)
@@ -0,0 +1,235 @@
+import threading
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Iterable, Iterator
+
+import pytest
+
+import prometheus_docker_discovery as discovery
+from prometheus_docker_discovery import JOB_LABEL, Inventory
+
+
+def summary(container_id: str, state: str = "running") -> dict:
+    return {
+        "Id": container_id,
+        "Names": [f"/{container_id[:12]}"],
+        "Image": "alpine:latest",
+        "ImageID": "sha256:" + "a" * 64,
+        "Labels": {JOB_LABEL: "job"},
+        "State": state,
+    }
+
+
+class FakeApi:
+    """
+    Container listing of a Docker daemon, as returned by the sparse `containers` call
+    """
+
+    def __init__(self, *summaries: dict):
+        self.summaries = {summary["Id"]: summary for summary in summaries}
+        self.listings = 0
+
+    def containers(self, all: bool, filters: dict) -> list[dict]:
+        self.listings += 1
+
+        return [
+            summary
+            for container_id, summary in self.summaries.items()
+            if filters.get("id", container_id) == container_id
+        ]
+
+
+class RecordingEvent(threading.Event):
+    """
+    Stop flag of the inventory that records the retry delays instead of sleeping
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.delays = list[float]()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        self.delays.append(timeout)
+
+        return self.is_set()
+
+
+@pytest.fixture
+def api() -> FakeApi:
+    return FakeApi(summary("a" * 64))
+
+
+def make_inventory(api: FakeApi, events=None) -> Inventory:
+    return Inventory(lambda: SimpleNamespace(api=api), events)
+
+
+def test_watch_reconnects_with_backoff(monkeypatch, api):
+    monkeypatch.setattr(discovery, "EVENTS_RETRY_DELAY", 1.0)
+    monkeypatch.setattr(discovery, "EVENTS_MAX_RETRY_DELAY", 3.0)
+    subscriptions = 0
+
+    def events() -> Iterable[dict]:
+        nonlocal subscriptions
+        subscriptions += 1
+
+        if subscriptions <= 4:
+            raise ConnectionError("Docker daemon unreachable")
+
+        if subscriptions == 5:
+            # the stream ends when the daemon restarts
+            api.summaries["b" * 64] = summary("b" * 64)
+            return iter([{"Type": "container", "Action": "start", "id": "b" * 64}])
+
+        inventory._stopped.set()
+        raise ConnectionError("Docker daemon unreachable")
+
+    inventory = make_inventory(api, events)
+    inventory._stopped = RecordingEvent()
+    inventory._watch()
+
+    # the delay doubles up to its maximum and starts over after a successful subscription
+    assert inventory._stopped.delays == [1.0, 2.0, 3.0, 3.0, 1.0]
+    assert subscriptions == 6
+    assert {container.id for container in inventory.containers()} == {
+        "a" * 64,
+        "b" * 64,
+    }
+
+
+def test_watch_resyncs_after_subscribing(api):
+    def events() -> Iterable[dict]:
+        # containers started while the stream was down are only seen by the listing
+        api.summaries["b" * 64] = summary("b" * 64)
+        inventory._stopped.set()
+        return iter([])
+
+    inventory = make_inventory(api, events)
+    inventory._stopped = RecordingEvent()
+    inventory._watch()
+
+    assert api.listings == 1
+    assert {container.id for container in inventory.containers()} == {
+        "a" * 64,
+        "b" * 64,
+    }
+
+
+class BlockingStream:
+    """
+    Events stream that waits for events until it is closed, like the one of docker-py
+    """
+
+    def __init__(self):
+        self.subscribed = threading.Event()
+        self.closed = threading.Event()
+
+    def __iter__(self) -> Iterator[dict]:
+        self.subscribed.set()
+        self.closed.wait(5)
+
+        if self.closed.is_set():
+            raise ConnectionError("Stream closed")
+
+        return iter([])
+
+    def close(self):
+        self.closed.set()
+
+
+def test_stop_closes_the_stream(api):
+    stream = BlockingStream()
+    inventory = make_inventory(api, lambda: stream)
+    inventory.start()
+
+    assert stream.subscribed.wait(5)
+
+    inventory.stop()
+
+    assert stream.closed.is_set()
+
+
+def test_containers_never_list(api):
+    inventory = make_inventory(api)
+
+    assert inventory.containers() == []
+    assert api.listings == 0
+
+    inventory.resync()
+
+    assert [container.id for container in inventory.containers()] == ["a" * 64]
+    assert api.listings == 1
+
+
+def test_apply_events(api):
+    inventory = make_inventory(api)
+    inventory.resync()
+    generation = inventory.generation
+
+    api.summaries["a" * 64] = summary("a" * 64, "paused")
+    inventory.apply({"Type": "container", "Action": "pause", "id": "a" * 64})
+
+    assert inventory.containers()[0].status == "paused"
+    assert inventory.generation == generation + 1
+
+    inventory.apply({"Type": "network", "Action": "connect", "id": "a" * 64})
+    inventory.apply({"Type": "container", "Action": "exec_start: sh", "id": "a" * 64})
+
+    assert inventory.generation == generation + 1
+
+    inventory.apply({"Type": "container", "Action": "destroy", "id": "a" * 64})
+
+    assert inventory.containers() == []
+    assert inventory.generation == generation + 2
+
+
+STARTED_AT = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def test_refresh_keeps_the_start_time(api):
+    inventory = make_inventory(api)
+    inventory.resync()
+    inventory.containers()[0].started_at = STARTED_AT
+    generation = inventory.generation
+
+    inventory.apply({"Type": "container", "Action": "update", "id": "a" * 64})
+
+    assert inventory.containers()[0].started_at == STARTED_AT
+    assert inventory.generation == generation
+
+
+@pytest.mark.parametrize("action", ["start", "restart", "die"])
+def test_start_events_clear_the_start_time(api, action):
+    inventory = make_inventory(api)
+    inventory.resync()
+    inventory.containers()[0].started_at = STARTED_AT
+
+    # the status is still running when a restart is only seen afterwards
+    inventory.apply({"Type": "container", "Action": action, "id": "a" * 64})
+
+    assert inventory.containers()[0].started_at is None
+
+
+def test_resync_keeps_the_start_times_of_an_uninterrupted_stream(api):
+    stream = BlockingStream()
+    inventory = make_inventory(api, lambda: stream)
+    inventory.start()
+
+    try:
+        assert stream.subscribed.wait(5)
+        inventory.containers()[0].started_at = STARTED_AT
+        inventory.resync()
+
+        assert inventory.containers()[0].started_at == STARTED_AT
+    finally:
+        inventory.stop()
+
+
+def test_resync_clears_the_start_times_after_a_gap(api):
+    inventory = make_inventory(api)
+    inventory.resync()
+    inventory.containers()[0].started_at = STARTED_AT
+
+    # without an events stream a restart may go unnoticed
+    inventory.resync()
+
+    assert inventory.containers()[0].started_at is None
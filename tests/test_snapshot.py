@@ -0,0 +1,125 @@
+import math
+from datetime import datetime, timezone
+
+import pytest
+
+import benchmark
+from docker_stats_worker import expand_stats, reduce_stats
+from prometheus_docker_discovery import (
+    JOB_LABEL,
+    ContainerInfo,
+    DockerHost,
+    build_snapshot,
+)
+
+CONTAINER = ContainerInfo(
+    "c" * 64, "container", {JOB_LABEL: "job"}, "running", "alpine", "sha256:a", {}
+)
+
+
+@pytest.fixture
+def host() -> DockerHost:
+    return DockerHost("local", "unix:///nonexistent/docker.sock")
+
+
+def column(host: DockerHost, stats: dict, name: str) -> float:
+    snapshot = build_snapshot(
+        host, [CONTAINER], {CONTAINER.id: stats}, datetime.now(timezone.utc)
+    )
+
+    return snapshot.columns[name][0]
+
+
+def test_oom_events_on_cgroup_v2(host):
+    memory_stats = {"usage": 100, "failcnt": 3, "stats": {"anon": 60, "file": 30}}
+
+    assert (
+        column(
+            host,
+            {"memory_stats": memory_stats},
+            "docker_container_memory_oom_events_total",
+        )
+        == 3
+    )
+
+
+def test_no_oom_events_on_cgroup_v1(host):
+    # failcnt counts the hits of the limit on cgroup v1
+    memory_stats = {"usage": 100, "failcnt": 3, "stats": {"cache": 30, "rss": 60}}
+
+    assert math.isnan(
+        column(
+            host,
+            {"memory_stats": memory_stats},
+            "docker_container_memory_oom_events_total",
+        )
+    )
+
+
+V1_STATS = {
+    "cpu_stats": {
+        "cpu_usage": {"total_usage": 4_000_000_000, "percpu_usage": [1, 2]},
+        "system_cpu_usage": 80_000_000_000,
+        "online_cpus": 2,
+    },
+    "precpu_stats": {
+        "cpu_usage": {"total_usage": 3_000_000_000},
+        "system_cpu_usage": 70_000_000_000,
+        "online_cpus": 2,
+    },
+    "memory_stats": {
+        "usage": 1000,
+        "limit": 4000,
+        "failcnt": 7,
+        "stats": {"cache": 300, "rss": 600, "total_inactive_file": 100, "pgfault": 5},
+    },
+    "networks": {
+        "eth0": {"rx_bytes": 10, "tx_bytes": 20, "rx_packets": 1},
+        "eth1": {"rx_bytes": 5, "tx_dropped": 2},
+    },
+    "blkio_stats": {
+        "io_service_bytes_recursive": [
+            {"major": 8, "minor": 0, "op": "Read", "value": 4096},
+            {"major": 8, "minor": 0, "op": "Write", "value": 512},
+            {"major": 8, "minor": 0, "op": "Total", "value": 4608},
+        ]
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "stats",
+    [
+        benchmark.FakeDocker(0, 0, {}).stats(1_700_000_000.0, False),
+        benchmark.FakeDocker(0, 0, {}).stats(1_700_000_000.0, True),
+        V1_STATS,
+        {**V1_STATS, "networks": None, "blkio_stats": {}},
+        {},
+    ],
+)
+def test_reduced_stats(host, stats):
+    full = build_snapshot(
+        host, [CONTAINER], {CONTAINER.id: stats}, datetime.now(timezone.utc)
+    )
+    full_columns = {name: list(column) for name, column in full.columns.items()}
+    reduced = build_snapshot(
+        host,
+        [CONTAINER],
+        {CONTAINER.id: expand_stats(reduce_stats(stats))},
+        datetime.now(timezone.utc),
+    )
+
+    for name, column in reduced.columns.items():
+        assert list(column) == pytest.approx(full_columns[name], nan_ok=True), name
+
+
+def test_cpu_usage(host):
+    assert column(host, V1_STATS, "docker_container_cpu_usage_percent") == 20.0
+
+
+def test_no_cpu_usage_without_previous_counters(host):
+    # one-shot stats of a container that was not collected before
+    stats = {**V1_STATS, "precpu_stats": {"cpu_usage": {"total_usage": 0}}}
+
+    assert math.isnan(column(host, stats, "docker_container_cpu_usage_percent"))
+    assert column(host, stats, "docker_container_cpu_usage_seconds_total") == 4.0
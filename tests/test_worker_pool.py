@@ -0,0 +1,26 @@
+import threading
+
+from prometheus_docker_discovery import WorkerPool
+
+
+def test_timed_out_run():
+    pool = WorkerPool(1)
+    release = threading.Event()
+
+    futures = pool.run(lambda _: release.wait(5), range(10), 10, timeout=0.1)
+    release.set()
+
+    # the first item was running, the others were still queued and are cancelled
+    assert futures[0].result() is True
+    assert all(future.cancelled() for future in futures[1:])
+    assert pool.queued == 0
+    assert pool.active == 0
+
+
+def test_run():
+    pool = WorkerPool(4)
+
+    futures = pool.run(lambda item: item * 2, range(10), 3)
+
+    assert [future.result() for future in futures] == list(range(0, 20, 2))
+    assert pool.queued == 0